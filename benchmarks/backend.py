@@ -0,0 +1,395 @@
+'''In-process stand-in for a mongod, implementing the part of the pymongo
+2.x client interface mongoom uses. Documents are stored as BSON and
+decoded on every read, so decoding costs resemble a real server. Use it
+with ``connect("bench", client=MemoryClient())``.
+
+Queries support equality, $in, $nin, $ne, $gt, $gte, $lt, $lte, $exists,
+$and and $or on top level fields. Updates support $set, $unset, $inc and
+$push.
+'''
+from collections import OrderedDict
+from copy import deepcopy
+from itertools import islice
+from bson import BSON, ObjectId
+from pymongo.errors import (BulkWriteError, CollectionInvalid,
+                            DuplicateKeyError)
+
+
+def compare(op, value, arg):
+    if op == "$in":
+        return value in arg
+    if op == "$nin":
+        return value not in arg
+    if op == "$ne":
+        return value != arg
+    if op == "$exists":
+        return (value is not MISSING) == bool(arg)
+    if value is MISSING:
+        return False
+    if op == "$gt":
+        return value > arg
+    if op == "$gte":
+        return value >= arg
+    if op == "$lt":
+        return value < arg
+    if op == "$lte":
+        return value <= arg
+    raise ValueError("Unsupported operator " + op)
+
+
+MISSING = object()
+
+
+def match(doc, spec):
+    for key, arg in spec.iteritems():
+        if key == "$and":
+            if not all(match(doc, s) for s in arg):
+                return False
+            continue
+        if key == "$or":
+            if not any(match(doc, s) for s in arg):
+                return False
+            continue
+        value = doc.get(key, MISSING)
+        if isinstance(arg, dict) and arg and all(
+                k.startswith("$") for k in arg):
+            if not all(compare(op, value, a) for op, a in arg.iteritems()):
+                return False
+        elif isinstance(value, list) and not isinstance(arg, list):
+            if arg not in value:
+                return False
+        elif value != arg:
+            return False
+    return True
+
+
+def project(doc, fields):
+    if not fields:
+        return doc
+    if isinstance(fields, (list, tuple)):
+        fields = dict((name, 1) for name in fields)
+    include = [k for k, v in fields.iteritems() if v and k != "_id"]
+    if include:
+        out = dict((k, doc[k]) for k in include if k in doc)
+        if fields.get("_id", 1) and "_id" in doc:
+            out["_id"] = doc["_id"]
+        return out
+    return dict((k, v) for k, v in doc.iteritems()
+                if k not in fields or fields[k])
+
+
+def apply_update(doc, update):
+    if not any(k.startswith("$") for k in update):
+        _id = doc["_id"]
+        doc.clear()
+        doc.update(deepcopy(update))
+        doc["_id"] = _id
+        return
+    for name, value in update.get("$set", {}).iteritems():
+        doc[name] = deepcopy(value)
+    for name in update.get("$unset", {}):
+        doc.pop(name, None)
+    for name, value in update.get("$inc", {}).iteritems():
+        doc[name] = doc.get(name, 0) + value
+    for name, value in update.get("$push", {}).iteritems():
+        doc.setdefault(name, []).append(deepcopy(value))
+
+
+class MemoryCursor(object):
+
+    def __init__(self, collection, spec=None, fields=None, **kwargs):
+        self.collection = collection
+        self.spec = spec or {}
+        self.fields = fields
+        self._sort = None
+        self._skip = 0
+        self._limit = 0
+        self._iter = None
+        self.alive = True
+
+    def sort(self, key, direction=1):
+        if isinstance(key, basestring):
+            key = [(key, direction)]
+        self._sort = key
+        return self
+
+    def skip(self, num):
+        self._skip = num
+        return self
+
+    def limit(self, num):
+        self._limit = num
+        return self
+
+    def batch_size(self, num):
+        return self
+
+    def hint(self, index):
+        return self
+
+    def max_time_ms(self, ms):
+        return self
+
+    def _matches(self):
+        docs = [doc for doc in self.collection._decoded(self.spec)
+                if match(doc, self.spec)]
+        if self._sort:
+            for key, direction in reversed(self._sort):
+                docs.sort(key=lambda doc: doc.get(key), reverse=direction < 0)
+        return docs
+
+    def count(self, with_limit_and_skip=False):
+        docs = self._matches()
+        if with_limit_and_skip:
+            docs = docs[self._skip:]
+            if self._limit:
+                docs = docs[:self._limit]
+        return len(docs)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self._iter is None:
+            docs = self._matches()[self._skip:]
+            if self._limit:
+                docs = islice(docs, abs(self._limit))
+            self._iter = (project(doc, self.fields) for doc in docs)
+        try:
+            return next(self._iter)
+        except StopIteration:
+            self.alive = False
+            raise
+
+
+class MemoryBulk(object):
+
+    def __init__(self, collection, ordered):
+        self.collection = collection
+        self.ordered = ordered
+        self.ops = []
+
+    def insert(self, doc):
+        self.ops.append(("insert", doc, None, False))
+
+    def find(self, spec):
+        return MemoryBulkFind(self, spec)
+
+    def execute(self, *args, **kwargs):
+        result = {"nInserted": 0, "nUpserted": 0, "nMatched": 0,
+                  "nModified": 0, "nRemoved": 0, "upserted": [],
+                  "writeErrors": []}
+        for index, (op, doc, spec, upsert) in enumerate(self.ops):
+            try:
+                if op == "insert":
+                    self.collection.insert(doc)
+                    result["nInserted"] += 1
+                else:
+                    matched = self.collection._update(spec, doc, upsert)
+                    result["nMatched"] += matched
+            except DuplicateKeyError as e:
+                result["writeErrors"].append(
+                    {"index": index, "code": 11000, "errmsg": str(e)})
+                if self.ordered:
+                    break
+        if result["writeErrors"]:
+            raise BulkWriteError(result)
+        return result
+
+
+class MemoryBulkFind(object):
+
+    def __init__(self, bulk, spec):
+        self.bulk = bulk
+        self.spec = spec
+        self._upsert = False
+
+    def upsert(self):
+        self._upsert = True
+        return self
+
+    def update_one(self, update):
+        self.bulk.ops.append(("update", update, self.spec, self._upsert))
+
+    update = update_one
+    replace_one = update_one
+
+
+class MemoryCollection(object):
+
+    def __init__(self, database, name, **options):
+        self.database = database
+        self.name = name
+        self.full_name = database.name + "." + name
+        self.options = options
+        self.docs = OrderedDict()
+        self.indexes = {"_id_": {"key": [("_id", 1)]}}
+
+    def _decoded(self, spec=None):
+        '''Decoded documents, only those with the _id spec asks for when
+        it selects by _id.'''
+
+        _id = (spec or {}).get("_id")
+        if _id is None:
+            datas = self.docs.values()
+        elif isinstance(_id, dict):
+            if set(_id) != set(["$in"]):
+                datas = self.docs.values()
+            else:
+                datas = [self.docs[i] for i in _id["$in"] if i in self.docs]
+        else:
+            datas = [self.docs[_id]] if _id in self.docs else []
+        return [BSON(data).decode() for data in datas]
+
+    def _store(self, doc):
+        for info in self.indexes.itervalues():
+            if not info.get("unique"):
+                continue
+            keys = [key for key, _ in info["key"]]
+            for other in self._decoded():
+                if other["_id"] != doc["_id"] and all(
+                        other.get(k) == doc.get(k) for k in keys):
+                    raise DuplicateKeyError("E11000 duplicate key", 11000)
+        self.docs[doc["_id"]] = BSON.encode(doc)
+        capped = self.options.get("max") if self.options.get("capped") else 0
+        while capped and len(self.docs) > capped:
+            self.docs.popitem(last=False)
+
+    def insert(self, doc_or_docs, *args, **kwargs):
+        docs = doc_or_docs
+        if isinstance(doc_or_docs, dict):
+            docs = [doc_or_docs]
+        ids = []
+        for doc in docs:
+            if "_id" not in doc:
+                doc["_id"] = ObjectId()
+            if doc["_id"] in self.docs:
+                raise DuplicateKeyError("E11000 duplicate key _id", 11000)
+            self._store(doc)
+            ids.append(doc["_id"])
+        return ids[0] if isinstance(doc_or_docs, dict) else ids
+
+    def _update(self, spec, update, upsert=False, multi=False):
+        matched = 0
+        for doc in self._decoded(spec):
+            if match(doc, spec):
+                apply_update(doc, update)
+                self._store(doc)
+                matched += 1
+                if not multi:
+                    break
+        if not matched and upsert:
+            doc = dict((k, v) for k, v in spec.iteritems()
+                       if not k.startswith("$"))
+            doc.setdefault("_id", ObjectId())
+            apply_update(doc, update)
+            self._store(doc)
+        return matched
+
+    def update(self, spec, update, upsert=False, multi=False, *args,
+               **kwargs):
+        return {"n": self._update(spec, update, upsert, multi)}
+
+    def save(self, doc, *args, **kwargs):
+        doc.setdefault("_id", ObjectId())
+        self._store(doc)
+        return doc["_id"]
+
+    def find(self, spec=None, fields=None, **kwargs):
+        return MemoryCursor(self, spec, fields, **kwargs)
+
+    def find_one(self, spec=None, fields=None, **kwargs):
+        if spec is not None and not isinstance(spec, dict):
+            spec = {"_id": spec}
+        for doc in self.find(spec, fields).limit(1):
+            return doc
+
+    def remove(self, spec=None, *args, **kwargs):
+        if spec is not None and not isinstance(spec, dict):
+            spec = {"_id": spec}
+        for doc in self._decoded(spec):
+            if match(doc, spec or {}):
+                del self.docs[doc["_id"]]
+
+    def count(self):
+        return len(self.docs)
+
+    def index_information(self):
+        return deepcopy(self.indexes)
+
+    def ensure_index(self, key_or_list, **kwargs):
+        if isinstance(key_or_list, basestring):
+            key_or_list = [(key_or_list, 1)]
+        name = kwargs.pop("name", None) or "_".join(
+            "{}_{}".format(k, d) for k, d in key_or_list)
+        info = dict(kwargs, key=list(key_or_list))
+        self.indexes[name] = info
+        return name
+
+    create_index = ensure_index
+
+    def drop_index(self, name):
+        self.indexes.pop(name, None)
+
+    def drop(self):
+        self.database.drop_collection(self.name)
+
+    def initialize_ordered_bulk_op(self):
+        return MemoryBulk(self, True)
+
+    def initialize_unordered_bulk_op(self):
+        return MemoryBulk(self, False)
+
+
+class MemoryDatabase(object):
+
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+        self.collections = {}
+
+    def __getitem__(self, name):
+        if name not in self.collections:
+            self.collections[name] = MemoryCollection(self, name)
+        return self.collections[name]
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return self[name]
+
+    def create_collection(self, name, **options):
+        if name in self.collections:
+            raise CollectionInvalid("collection {} already exists".format(name))
+        self.collections[name] = MemoryCollection(self, name, **options)
+        return self.collections[name]
+
+    def collection_names(self):
+        return list(self.collections)
+
+    def drop_collection(self, name):
+        self.collections.pop(getattr(name, "name", name), None)
+
+    def dereference(self, dbref):
+        return self[dbref.collection].find_one({"_id": dbref.id})
+
+
+class MemoryClient(object):
+    '''Stand-in for :class:`pymongo.mongo_client.MongoClient`.'''
+
+    def __init__(self, *args, **kwargs):
+        self.databases = {}
+
+    def __getitem__(self, name):
+        if name not in self.databases:
+            self.databases[name] = MemoryDatabase(self, name)
+        return self.databases[name]
+
+    def database_names(self):
+        return list(self.databases)
+
+    def drop_database(self, name):
+        self[getattr(name, "name", name)].collections.clear()
+
+    def close(self):
+        pass
@@ -0,0 +1,302 @@
+'''Benchmarks of mongoom's hot paths.
+
+Runs against an in-process stand-in by default, or a mongod with --mongod.
+Results are written as JSON. Each benchmark reports the median of its runs.
+
+With --baseline, runs are compared with benchmarks/baseline.json, made with
+the in-process backend, or another results file. Timings are divided by a
+pure python calibration loop timed in the same run, so ratios mostly
+cancel out the speed of the machine. A benchmark that became slower than
+the tolerance allows fails the run. Baselines of another backend are
+skipped. Refresh the baseline with --save-baseline.
+
+Usage::
+
+    python benchmarks/bench.py --json results.json
+    python benchmarks/bench.py --baseline
+    python benchmarks/bench.py --baseline other.json --tolerance 0.3
+    python benchmarks/bench.py --save-baseline benchmarks/baseline.json
+    python benchmarks/bench.py --mongod --host localhost --port 27017
+'''
+import argparse
+import gc
+import json
+import os
+import platform
+import sys
+from collections import OrderedDict
+from time import time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from mongoom import Document, EmbeddedDocument, Field, ListField, connect
+from mongoom.connection import drop_database
+from mongoom.identity import IdentityMap
+from backend import MemoryClient
+
+
+DATABASE = "mongoom_bench"
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        "baseline.json")
+BENCHMARKS = OrderedDict()
+
+
+def benchmark(number):
+    '''Register a benchmark running number operations. The decorated
+    function prepares the data and returns a callable doing the timed
+    work.'''
+
+    def register(func):
+        BENCHMARKS[func.__name__] = (func, number)
+        return func
+    return register
+
+
+class Comment(EmbeddedDocument):
+    user = Field(basestring)
+    text = Field(basestring)
+
+
+class Sample(Document):
+    _collection = {"name": "BenchSample"}
+    name = Field(basestring, required=True)
+    count = Field(int, default=0)
+    tags = ListField(basestring)
+    comment = Field(Comment)
+    parent = Field(Document)
+
+
+def samples(num):
+    return [Sample(name="sample", count=i, tags=["a", "b"],
+                   comment=Comment(user="frank", text="hi"))
+            for i in xrange(num)]
+
+
+@benchmark(10000)
+def document_init(num):
+    def run():
+        for i in xrange(num):
+            Sample(name="sample", count=i)
+    return run
+
+
+@benchmark(100000)
+def field_get(num):
+    sample = Sample(name="sample", count=1)
+
+    def run():
+        for i in xrange(num):
+            sample.name
+            sample.count
+    return run
+
+
+@benchmark(100000)
+def field_set(num):
+    sample = Sample(name="sample", count=1)
+
+    def run():
+        for i in xrange(num):
+            sample.count = i
+    return run
+
+
+@benchmark(20000)
+def listfield(num):
+    sample = Sample(name="sample", tags=["a", "b", "c"])
+
+    def run():
+        for i in xrange(num):
+            sample.tags.append("d")
+            sample.tags[0]
+            sample.tags.pop()
+    return run
+
+
+@benchmark(20000)
+def embedded(num):
+    sample = Sample(name="sample")
+
+    def run():
+        for i in xrange(num):
+            sample.comment = Comment(user="frank", text="hi")
+            sample.comment.text
+            sample.comment.text = "bye"
+    return run
+
+
+@benchmark(10000)
+def generate_objects(num):
+    Sample.save_many(samples(num))
+
+    def run():
+        for sample in Sample.find():
+            pass
+    return run
+
+
+@benchmark(1000)
+def save_find(num):
+    def run():
+        for i in xrange(num):
+            sample = Sample(name="sample", count=i).save()
+            Sample.find_one(_id=sample._id)
+    return run
+
+
+@benchmark(1000)
+def dereference_chain(num, depth=5):
+    heads = []
+    for i in xrange(num):
+        parent = Sample(name="sample").save()
+        for j in xrange(depth - 1):
+            parent = Sample(name="sample", count=j, parent=parent).save()
+        heads.append(parent._id)
+
+    def run():
+        # Only ids are held, every link is loaded from the database
+        for _id in heads:
+            sample = Sample.find_one(_id=_id)
+            while "parent" in sample._data:
+                sample = sample.parent
+    return run
+
+
+@benchmark(100000)
+def identity_map(num):
+    imap = IdentityMap(1000)
+    objects = [Sample.__new__(Sample) for i in xrange(5000)]
+
+    def run():
+        for i in xrange(num):
+            key = i % 5000
+            imap.set(key, objects[key])
+            imap.get(key - 1)
+    return run
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def calibrate(repeat, num=200000):
+    ''':return: Median operations per second of a pure python loop, the
+    yardstick benchmarks are measured with.'''
+
+    timings = []
+    for i in xrange(repeat):
+        data = {}
+        start = time()
+        for j in xrange(num):
+            data[j & 1023] = j
+            data.get(j - 1)
+        timings.append(time() - start)
+    return num / median(timings)
+
+
+def run_benchmark(func, number, repeat):
+    ''':return: Median seconds of repeat runs.'''
+
+    timings = []
+    for i in xrange(repeat):
+        drop_database(DATABASE)
+        work = func(number)
+        gc.collect()
+        start = time()
+        work()
+        timings.append(time() - start)
+    return median(timings)
+
+
+def compare(results, baseline, tolerance):
+    ''':return: Names of benchmarks slower than baseline by more than
+    tolerance, comparing calibrated speeds when both runs have them.'''
+
+    regressions = []
+    for name, result in results.iteritems():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        key = "calibrated" if "calibrated" in base else "ops_per_sec"
+        ratio = result[key] / base[key]
+        result["baseline_ratio"] = ratio
+        if ratio < 1 - tolerance:
+            regressions.append(name)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="mongoom benchmarks")
+    parser.add_argument("names", nargs="*", help="Benchmarks to run")
+    parser.add_argument("--mongod", action="store_true",
+                        help="Use a mongod instead of the in-process backend")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=27017)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--scale", type=float, default=1.0,
+                        help="Multiply the number of operations")
+    parser.add_argument("--json", help="Write results to this file")
+    parser.add_argument("--baseline", nargs="?", const=BASELINE,
+                        help="Compare with this results file, "
+                             "benchmarks/baseline.json if none is given")
+    parser.add_argument("--tolerance", type=float, default=0.3,
+                        help="Allowed slowdown relative to the baseline")
+    parser.add_argument("--save-baseline", help="Write results as baseline")
+    args = parser.parse_args(argv)
+
+    if args.mongod:
+        connect(DATABASE, args.host, args.port)
+    else:
+        connect(DATABASE, client=MemoryClient())
+
+    calibration = calibrate(args.repeat)
+    results = OrderedDict()
+    for name, (func, number) in BENCHMARKS.iteritems():
+        if args.names and name not in args.names:
+            continue
+        number = max(1, int(number * args.scale))
+        seconds = run_benchmark(func, number, args.repeat)
+        ops_per_sec = number / seconds if seconds else 0
+        results[name] = {"ops": number, "seconds": seconds,
+                         "ops_per_sec": ops_per_sec,
+                         "calibrated": ops_per_sec / calibration}
+        print "{:<20} {:>12.0f} ops/s".format(name, results[name]["ops_per_sec"])
+    drop_database(DATABASE)
+
+    backend = "mongod" if args.mongod else "memory"
+    regressions = []
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get("backend", "memory") != backend:
+            print "Skipping {} baseline {}".format(
+                baseline.get("backend"), args.baseline)
+            baseline = None
+    if baseline:
+        regressions = compare(results, baseline["results"], args.tolerance)
+        for name in results:
+            if "baseline_ratio" in results[name]:
+                print "{:<20} {:>11.2f}x {}".format(
+                    name, results[name]["baseline_ratio"],
+                    "REGRESSION" if name in regressions else "")
+
+    output = {
+        "python": platform.python_version(),
+        "backend": backend,
+        "calibration": calibration,
+        "results": results,
+        "regressions": regressions,
+    }
+    for path in (args.json, args.save_baseline):
+        if path:
+            with open(path, "w") as f:
+                json.dump(output, f, indent=2, separators=(",", ": "))
+                f.write("\n")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,67 @@
+'''Compare the memory used by regular and compact :class:`Document`
+instances loaded from the database. Each layout is measured in a fresh
+process, no database is needed.
+
+Usage::
+
+    python benchmarks/memory.py [count]
+'''
+import gc
+import os
+import subprocess
+import sys
+from datetime import datetime
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from bson import DBRef, ObjectId
+from mongoom import Document, Field
+
+
+LAYOUTS = ("regular", "compact")
+
+
+def rss():
+    ''':return: Resident memory of this process in bytes.'''
+
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def sample_class(compact):
+
+    class Sample(Document):
+        _compact = compact
+        ref = Field(Document)
+        kind = Field(basestring)
+        count = Field(int)
+        created = Field(datetime)
+
+    return Sample
+
+
+def measure(layout, count):
+    Sample = sample_class(layout == "compact")
+    ref = DBRef("User", ObjectId())
+    docs = [{"_id": ObjectId(), "_type": "Sample", "ref": ref,
+             "kind": "update", "count": i, "created": datetime.utcnow()}
+            for i in xrange(count)]
+    gc.collect()
+    before = rss()
+    documents = [Sample.from_son(doc) for doc in docs]
+    del docs
+    gc.collect()
+    return (rss() - before) / float(len(documents))
+
+
+def main(count=200000):
+    print "{:>10} {:>14}".format("layout", "bytes/document")
+    for layout in LAYOUTS:
+        out = subprocess.check_output(
+            [sys.executable, __file__, str(count), layout])
+        print "{:>10} {:>14.0f}".format(layout, float(out))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 2:
+        print measure(sys.argv[2], int(sys.argv[1]))
+    else:
+        main(*[int(arg) for arg in sys.argv[1:2]])
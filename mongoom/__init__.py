@@ -1,7 +1,7 @@
 from .documents import Document, EmbeddedDocument
 from .fields import BaseField, Field, ObjectIdField, ListField
 from .connection import connect
-from .events import Event
+from .events import Event, Publisher, set_publisher
 from .subscriber import Subscriber
 
 __version__ = "0.1.1"
@@ -0,0 +1,80 @@
+'''Export and import the collections of :class:`Document` classes.
+
+Usage::
+
+    python -m mongoom export myapp.models:User users.bson.gz --db mydb
+    python -m mongoom import myapp.models:User users.bson.gz --db mydb --upsert
+
+Interrupted transfers continue where they stopped with --resume.
+'''
+import argparse
+import importlib
+import sys
+from bson import ObjectId
+from bson.json_util import loads
+from .connection import connect
+from .registry import get_type
+from .transfer import export_collection, import_collection, report
+
+
+def load_class(path):
+    ''':return: :class:`Document` class from a "module:Class" path.'''
+
+    module, _, name = path.rpartition(":")
+    if module:
+        module = importlib.import_module(module)
+        return getattr(module, name, None) or get_type(name)
+    return get_type(name)
+
+
+def parse_id(value):
+    '''Parse an _id given as ObjectId hex or extended JSON.'''
+
+    if ObjectId.is_valid(value):
+        return ObjectId(value)
+    return loads(value)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m mongoom", description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest="command")
+    for command in ("export", "import"):
+        sub = commands.add_parser(command)
+        sub.add_argument("document", help="Document class as module:Class")
+        sub.add_argument("path", help=".bson or .jsonl file, may end in .gz")
+        sub.add_argument("--db", required=True, help="Database name")
+        sub.add_argument("--host", default="localhost")
+        sub.add_argument("--port", type=int, default=27017)
+        sub.add_argument("--batch-size", type=int, default=1000)
+        sub.add_argument("--after", type=parse_id,
+                         help="Skip documents up to this _id")
+        sub.add_argument("--resume", action="store_true",
+                         help="Continue an interrupted transfer")
+        sub.add_argument("--quiet", action="store_true",
+                         help="Do not report progress")
+        if command == "export":
+            sub.add_argument("--query", type=loads, default=None,
+                             help="Extended JSON query of documents to export")
+        else:
+            sub.add_argument("--upsert", action="store_true",
+                             help="Replace documents with the same _id")
+    args = parser.parse_args(argv)
+
+    doc_type = load_class(args.document)
+    if doc_type is None:
+        parser.error("Unknown Document class {}".format(args.document))
+    connect(args.db, args.host, args.port)
+    progress = None if args.quiet else report
+    if args.command == "export":
+        export_collection(doc_type, args.path, args.query, args.after,
+                          args.resume, args.batch_size, progress)
+    else:
+        import_collection(doc_type, args.path, args.upsert, args.after,
+                          args.resume, args.batch_size, progress)
+    if progress:
+        sys.stderr.write("\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+from itertools import islice
+from threading import Lock
+try:
+    from concurrent.futures import Future, ThreadPoolExecutor
+except ImportError:
+    Future = ThreadPoolExecutor = None
+
+
+EXECUTOR = None
+EXECUTOR_LOCK = Lock()
+MAX_WORKERS = 8
+
+
+def set_executor(executor):
+    '''Use executor to run all asynchronous operations. Any
+    :class:`concurrent.futures.Executor` works, its worker count bounds the
+    number of operations in flight.'''
+
+    global EXECUTOR
+    EXECUTOR = executor
+
+
+def get_executor():
+    '''Returns the executor running asynchronous operations, creating a
+    :class:`concurrent.futures.ThreadPoolExecutor` of MAX_WORKERS threads on
+    first use. Requires the futures package on Python 2.'''
+
+    global EXECUTOR
+    if EXECUTOR is None:
+        if ThreadPoolExecutor is None:
+            raise ImportError(
+                "Asynchronous operations require concurrent.futures, "
+                "install the futures package.")
+        with EXECUTOR_LOCK:
+            if EXECUTOR is None:
+                EXECUTOR = ThreadPoolExecutor(MAX_WORKERS)
+    return EXECUTOR
+
+
+def submit(fn, *args, **kwargs):
+    '''Run fn on the executor.
+
+    :return: :class:`concurrent.futures.Future` of fn's result.
+    '''
+
+    return get_executor().submit(fn, *args, **kwargs)
+
+
+def fetch(iterable, size=None):
+    ''':return: List of the first size items of iterable, all when None.'''
+
+    return list(islice(iterable, size))
+
+
+def chain(source, target):
+    '''Copy the result or exception of the done future source to
+    target.'''
+
+    error = source.exception()
+    if error is not None:
+        target.set_exception(error)
+    else:
+        target.set_result(source.result())
+
+
+class Batches(object):
+    '''Reads lists of size items of an iterable on the executor, one
+    batch at a time. :meth:`next_batch` never blocks, it returns a
+    :class:`concurrent.futures.Future` of the next batch. While a batch is
+    being used the one after it is read in the background.
+
+    :param iterable: Iterable read in batches, only ever used from one
+        executor thread at a time.
+    :param size: Number of items per batch.
+    '''
+
+    def __init__(self, iterable, size):
+        self.size = size
+        self._iterator = iter(iterable)
+        self._lock = Lock()
+        self._ahead = submit(fetch, self._iterator, size)
+
+    def _read(self, done, target):
+        if done.exception() is not None or not done.result():
+            chain(done, target)  # Past the end or failed, stay there
+        else:
+            submit(fetch, self._iterator, self.size).add_done_callback(
+                lambda future: chain(future, target))
+
+    def next_batch(self):
+        ''':return: :class:`concurrent.futures.Future` of a list of the
+        next up to size items, an empty list once all items were read.'''
+
+        with self._lock:
+            future = self._ahead
+            self._ahead = Future()
+        future.add_done_callback(
+            lambda done, target=self._ahead: self._read(done, target))
+        return future
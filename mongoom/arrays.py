@@ -0,0 +1,128 @@
+from collections import OrderedDict
+from datetime import datetime
+from itertools import islice
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# Stored in place of missing values, by dtype kind. Floats, datetimes and
+# objects have their own missing values, NaN, NaT and None, the others are
+# masked.
+FILL = {"b": False, "i": 0, "u": 0, "f": float("nan"), "U": u"", "S": ""}
+MASKED = frozenset("biuUS")
+
+
+def field_dtype(field, string_width=None):
+    ''':return: numpy dtype for the values of a :class:`BaseField`.
+
+    Fields of bool, int, float and datetime get bool, int64, float64 and
+    datetime64[ms] arrays. Strings are fixed width unicode when
+    string_width is given. Everything else, including fields mixing types,
+    is stored as objects.
+    '''
+
+    types = [t for t in getattr(field, "types", ()) if isinstance(t, type)]
+    if not types:
+        return numpy.dtype(object)
+    if all(issubclass(t, bool) for t in types):
+        return numpy.dtype(bool)
+    if all(issubclass(t, (int, long)) and not issubclass(t, bool)
+           for t in types):
+        return numpy.dtype("i8")
+    if all(issubclass(t, (int, long, float)) for t in types):
+        return numpy.dtype("f8")
+    if all(issubclass(t, datetime) for t in types):
+        return numpy.dtype("datetime64[ms]")
+    if string_width and all(issubclass(t, basestring) for t in types):
+        return numpy.dtype("U{}".format(string_width))
+    return numpy.dtype(object)
+
+
+def allocate(dtypes, size, structured):
+    ''':return: (table, columns), table is the structured array or None and
+    columns an OrderedDict of name to array.'''
+
+    if structured:
+        table = numpy.empty(size, [(str(name), dtype) for name, dtype in dtypes])
+        return table, OrderedDict((name, table[name]) for name, _ in dtypes)
+    columns = OrderedDict(
+        (name, numpy.empty(size, dtype)) for name, dtype in dtypes)
+    return None, columns
+
+
+def to_arrays(cursor, dtypes, size, structured=False, batch_size=1000,
+              fill=None):
+    '''Read a cursor into numpy arrays without decoding documents.
+
+    Missing values of float, datetime and object arrays are NaN, NaT and
+    None. Bool, int and string arrays have no such value, they are
+    returned as :class:`numpy.ma.MaskedArray` with missing values masked,
+    unless fill gives a value for them.
+
+    :param cursor: :class:`pymongo.cursor.Cursor` of raw documents.
+    :param dtypes: List of (field name, numpy dtype) pairs.
+    :param size: Expected number of documents, arrays grow if there are
+        more.
+    :param structured: Return one structured array instead of a dict.
+    :param batch_size: Number of documents copied into the arrays at once.
+    :param fill: Dictionary of field name to the value stored for missing
+        values instead of masking them.
+    :return: OrderedDict of field name to array, or a structured array.
+    '''
+
+    if numpy is None:
+        raise ImportError("find_arrays requires numpy.")
+
+    fill = fill or {}
+    table, columns = allocate(dtypes, size, structured)
+    masks = dict((name, numpy.zeros(size, bool)) for name, dtype in dtypes
+                 if dtype.kind in MASKED and name not in fill)
+    count = 0
+    while True:
+        batch = list(islice(cursor, batch_size))
+        if not batch:
+            break
+        end = count + len(batch)
+        if end > size:
+            size = max(end, size * 2)
+            new_table, new_columns = allocate(dtypes, size, structured)
+            for name in columns:
+                new_columns[name][:count] = columns[name][:count]
+            table, columns = new_table, new_columns
+            for name, mask in masks.items():
+                masks[name] = numpy.zeros(size, bool)
+                masks[name][:count] = mask[:count]
+        for name, array in columns.iteritems():
+            values = [doc.get(name) for doc in batch]
+            kind = array.dtype.kind
+            if kind == "O":
+                for i, value in enumerate(values, count):
+                    array[i] = value
+                continue
+            if name in masks:
+                masks[name][count:end] = [v is None for v in values]
+            if kind in FILL:
+                value = fill.get(name, FILL[kind])
+                values = [value if v is None else v for v in values]
+            array[count:end] = values
+        count = end
+
+    masks = dict((name, mask[:count]) for name, mask in masks.items()
+                 if mask[:count].any())
+    if structured:
+        if count < size:
+            table = table[:count].copy()
+        if not masks:
+            return table
+        mask = numpy.zeros(count, [(str(name), bool) for name, _ in dtypes])
+        for name, values in masks.items():
+            mask[str(name)] = values
+        return numpy.ma.masked_array(table, mask)
+    if count < size:
+        for name in columns:
+            columns[name] = columns[name][:count].copy()
+    for name, mask in masks.items():
+        columns[name] = numpy.ma.masked_array(columns[name], mask)
+    return columns
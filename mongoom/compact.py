@@ -0,0 +1,219 @@
+from .lazy import LazyData
+
+
+class CompactData(object):
+    '''Fixed layout storage of a compact :class:`Document`'s values. Each
+    field of the document class has a slot, so an instance costs a pointer
+    per field instead of a hash table. Keys that are not fields, like
+    fields removed from a schema, go to an overflow dict created on demand.
+
+    Made from a :class:`LazyData`, the undecoded fields stay in it and
+    each is decoded into its slot the first time it is read. The
+    :class:`LazyData` and its BSON are released once all fields are read.
+
+    Supports the parts of the dict interface :class:`Document` relies on.
+    Use :meth:`copy` for a plain dict.
+    '''
+
+    __slots__ = ("_extra", "_source")
+    _names = ()
+    _layout = {}
+
+    def __init__(self, data=None):
+        self._extra = None
+        self._source = None
+        if isinstance(data, LazyData):
+            self._source = data
+            data = dict(dict.items(data))
+        if data:
+            for name, value in data.iteritems():
+                self[name] = value
+        self._release()
+
+    def _release(self):
+        if self._source is not None and not self._source.pending:
+            self._source = None
+
+    def _discard(self, name):
+        '''Remove name from the lazy source, True if it was there.'''
+
+        source = self._source
+        if source is None or name not in source:
+            return False
+        del source[name]
+        self._release()
+        return True
+
+    def _decode(self, name):
+        '''Move the value of name from the lazy source to its slot.'''
+
+        source = self._source
+        if source is None or name not in source:
+            raise KeyError(name)
+        value = source[name]
+        self[name] = value
+        return value
+
+    def __getitem__(self, name):
+        slot = self._layout.get(name)
+        if slot is None:
+            if self._extra is not None and name in self._extra:
+                return self._extra[name]
+            return self._decode(name)
+        try:
+            return slot.__get__(self)
+        except AttributeError:
+            return self._decode(name)
+
+    def __setitem__(self, name, value):
+        self._discard(name)
+        slot = self._layout.get(name)
+        if slot is None:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[name] = value
+        else:
+            slot.__set__(self, value)
+
+    def __delitem__(self, name):
+        if self._discard(name):
+            return
+        slot = self._layout.get(name)
+        if slot is None:
+            if self._extra is None:
+                raise KeyError(name)
+            del self._extra[name]
+            return
+        try:
+            slot.__delete__(self)
+        except AttributeError:
+            raise KeyError(name)
+
+    def __contains__(self, name):
+        slot = self._layout.get(name)
+        if slot is not None:
+            try:
+                slot.__get__(self)
+                return True
+            except AttributeError:
+                pass
+        elif self._extra is not None and name in self._extra:
+            return True
+        return self._source is not None and name in self._source
+
+    def __iter__(self):
+        for name in self._names:
+            if name in self:
+                yield name
+        if self._extra:
+            for name in list(self._extra):
+                yield name
+        if self._source is not None:
+            for name in self._source.pending:
+                if name not in self._layout:
+                    yield name
+
+    def __len__(self):
+        return sum(1 for name in self)
+
+    def __eq__(self, other):
+        return self.copy() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "<{}({!r})>".format(self.__class__.__name__, self.copy())
+
+    def keys(self):
+        return list(self)
+
+    def iteritems(self):
+        for name in self:
+            yield name, self[name]
+
+    def items(self):
+        return list(self.iteritems())
+
+    def values(self):
+        return [value for name, value in self.iteritems()]
+
+    def get(self, name, default=None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+    def pop(self, name, *default):
+        try:
+            value = self[name]
+        except KeyError:
+            if default:
+                return default[0]
+            raise
+        del self[name]
+        return value
+
+    def setdefault(self, name, default=None):
+        try:
+            return self[name]
+        except KeyError:
+            self[name] = default
+            return default
+
+    def update(self, data):
+        for name, value in data.iteritems():
+            self[name] = value
+
+    def copy(self):
+        ''':return: A plain dict of the data.'''
+
+        return dict(self.iteritems())
+
+
+def compact_data(cls):
+    '''Create the :class:`CompactData` subclass holding the fields of a
+    compact :class:`Document` class.'''
+
+    names = cls._schema.names
+    # Prefixed slot names can not shadow CompactData's methods
+    slots = tuple("_f_" + name for name in names)
+    data_cls = type(cls.__name__ + "Data", (CompactData,),
+                    {"__slots__": slots})
+    data_cls._names = names
+    data_cls._layout = dict(
+        (name, data_cls.__dict__[slot]) for name, slot in zip(names, slots))
+    return data_cls
+
+
+class Forgetful(object):
+    '''Stands in for the decoded value and reference dicts of compact
+    documents, storing nothing.'''
+
+    __slots__ = ()
+
+    def __getitem__(self, key):
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        pass
+
+    def __contains__(self, key):
+        return False
+
+    def get(self, key, default=None):
+        return default
+
+    def pop(self, key, *default):
+        if default:
+            return default[0]
+        raise KeyError(key)
+
+    def update(self, *args, **kwargs):
+        pass
+
+    def clear(self):
+        pass
+
+
+FORGETFUL = Forgetful()
@@ -1,69 +1,204 @@
+import os
+from threading import RLock
 from pymongo import MongoClient
 from pymongo.errors import CollectionInvalid
+from .indexes import ensure_indexes, index_name
+from .monitor import operation
 
 
+DEFAULT = "default"
 CONNECTION = None
 DATABASE = None
-
-
-def connect(database, host="localhost", port=27017, **kwargs):
-    '''Connect to a database at given host and port. Sets two global
-    attributes, CONNECTION and DATABASE.
+CONNECTIONS = {}
+DATABASES = {}
+SETTINGS = {}
+PID = os.getpid()
+ENSURED = {}
+ENSURED_LOCK = RLock()
+
+
+def connect(database, host="localhost", port=27017, client=None,
+            alias=DEFAULT, **kwargs):
+    '''Connect to a database at given host and port. Connections are
+    registered under an alias, :class:`Document` classes use the "default"
+    connection unless they set a _connection attribute. The default
+    connection is also available as the global attributes CONNECTION and
+    DATABASE.
 
     :param database: Name of database to use.
     :param host: Host address
     :param port: Host port
+    :param client: Use this client instead of connecting to host and port,
+        any object with the :class:`pymongo.mongo_client.MongoClient`
+        interface works.
+    :param alias: Name of the connection.
     :param kwargs: Extra keyword arguments for
-        :class:`pymongo.mongo_client.MongoClient`
+        :class:`pymongo.mongo_client.MongoClient`, like max_pool_size,
+        socketTimeoutMS, waitQueueTimeoutMS or read_preference.
     :return: :class:`pymongo.mongo_client.MongoClient` instance.
 
     Usage::
 
         c = connect("test_db", "localhost", 27017)
+        connect("stats", "analytics.local", alias="analytics",
+                max_pool_size=4, socketTimeoutMS=60000,
+                read_preference=ReadPreference.SECONDARY_PREFERRED)
     '''
 
     global CONNECTION
     global DATABASE
-    c = MongoClient(host, port, **kwargs)
-    CONNECTION = c
-    DATABASE = c[database]
+    global PID
+    c = client if client is not None else MongoClient(host, port, **kwargs)
+    PID = os.getpid()
+    if client is None:
+        SETTINGS[alias] = (database, host, port, kwargs)
+    else:
+        SETTINGS.pop(alias, None)
+    CONNECTIONS[alias] = c
+    DATABASES[alias] = c[database]
+    if alias == DEFAULT:
+        CONNECTION = c
+        DATABASE = c[database]
+    invalidate(connection=alias)
     return c
 
 
-def get_database():
-    '''Get database'''
+def disconnect(alias=DEFAULT):
+    '''Close and forget the connection registered under alias.'''
+
+    global CONNECTION
     global DATABASE
-    return DATABASE
+    c = CONNECTIONS.pop(alias, None)
+    DATABASES.pop(alias, None)
+    SETTINGS.pop(alias, None)
+    if alias == DEFAULT:
+        CONNECTION = None
+        DATABASE = None
+    invalidate(connection=alias)
+    if c is not None:
+        c.close()
+
+
+def after_fork():
+    '''Connect again with the settings given to :func:`connect`, as
+    clients must not be shared with a forked process. Clients passed to
+    :func:`connect` are kept. Called by :func:`get_collection` when it
+    runs in a new process, call it directly before using
+    :func:`get_connection` or :func:`get_database` after a fork.'''
+
+    global PID
+    with ENSURED_LOCK:
+        if PID == os.getpid():
+            return
+        for alias, (database, host, port, kwargs) in SETTINGS.items():
+            connect(database, host, port, alias=alias, **kwargs)
+        ENSURED.clear()
+        PID = os.getpid()
+
+
+def get_database(alias=None, name=None):
+    '''Get database
+
+    :param alias: Name of the connection, the default connection if None.
+    :param name: Name of the database, the database given to
+        :func:`connect` if None.
+    :return: :class:`pymongo.database.Database` or None if not connected.
+    '''
 
+    alias = alias or DEFAULT
+    if name is None:
+        return DATABASES.get(alias)
+    c = CONNECTIONS.get(alias)
+    return None if c is None else c[name]
 
-def get_connection():
-    '''Get global connection.'''
-    global CONNECTION
-    return CONNECTION
 
+def get_connection(alias=None):
+    '''Get a connection by alias, the default connection if None.'''
 
-def get_collection(index_kwargs=None, coll_kwargs=None):
+    return CONNECTIONS.get(alias or DEFAULT)
+
+
+def get_collection(index_kwargs=None, coll_kwargs=None, connection=None,
+                   database=None):
     '''Gets a collection from index_kwargs and coll_kwargs.
     If a collection does not exist create collection using coll_kwargs.
     If an index does not exist, ensure an index using index_kwargs.
 
+    Ensured collections and indexes are recorded in ENSURED, keyed by
+    (connection alias, database name, collection name), so only the first
+    call for a collection talks to the server. Use :func:`invalidate` when
+    a collection or database is dropped outside of mongoom.
+
     :param index_kwargs: Dictionary matching the signature of
-        :func:`pymongo.database.ensure_index`.
+        :func:`pymongo.database.ensure_index`, or a list of them.
     :param coll_kwargs: Dictionary matching the signature of
         :func:`pymongo.database.create_collection`
+    :param connection: Connection alias, the default connection if None.
+    :param database: Database name, the connection's database if None.
     '''
-    global DATABASE
-    try:
-        DATABASE.create_collection(**coll_kwargs)
-    except CollectionInvalid:
-        pass
-    collection = DATABASE[coll_kwargs["name"]]
+    if PID != os.getpid():
+        after_fork()
+    with operation("get_collection", coll_kwargs["name"]):
+        return _get_collection(index_kwargs, coll_kwargs, connection, database)
+
+
+def _get_collection(index_kwargs, coll_kwargs, alias, name):
+    alias = alias or DEFAULT
+    db = get_database(alias, name)
+    if db is None:
+        raise ValueError(
+            "No connection named {!r}, use connect(..., alias={!r})".format(
+                alias, alias))
+    ensured_key = (alias, db.name, coll_kwargs["name"])
+    ensured = ENSURED.get(ensured_key)
+    if ensured is None:
+        with ENSURED_LOCK:
+            ensured = ENSURED.get(ensured_key)
+            if ensured is None:
+                try:
+                    db.create_collection(**coll_kwargs)
+                except CollectionInvalid:
+                    pass
+                ensured = (db[coll_kwargs["name"]], set())
+                ENSURED[ensured_key] = ensured
+    collection, indexes = ensured
     if index_kwargs:
-        indices = collection.index_information()
-        index_name = "_".join(
-            [str(item) for key in index_kwargs["key_or_list"] for item in key])
-        if not index_name in indices:
-            collection.ensure_index(**index_kwargs)
+        if isinstance(index_kwargs, dict):
+            index_kwargs = [index_kwargs]
+        if any(index_name(index) not in indexes for index in index_kwargs):
+            with ENSURED_LOCK:
+                ensure_indexes(collection, index_kwargs, indexes)
     return collection
 
 
+def invalidate(name=None, database=None, connection=None):
+    '''Forget ensured collections and indexes so the next
+    :func:`get_collection` call checks the server again.
+
+    :param name: Collection name, all collections when None.
+    :param database: Database name, all databases when None.
+    :param connection: Connection alias, all connections when None.
+    '''
+    with ENSURED_LOCK:
+        for key in ENSURED.keys():
+            if ((connection is None or key[0] == connection) and
+                    (database is None or key[1] == database) and
+                    (name is None or key[2] == name)):
+                del ENSURED[key]
+
+
+def drop_collection(name, connection=None, database=None):
+    '''Drop a collection from the current database, or a database of
+    another connection. Other connections to the same database forget
+    the collection too.'''
+    db = get_database(connection, database)
+    db.drop_collection(name)
+    invalidate(name, db.name)
+
+
+def drop_database(name, connection=None):
+    '''Drop a database using the current connection, or the connection
+    registered under another alias.'''
+    alias = connection or DEFAULT
+    get_connection(alias).drop_database(name)
+    invalidate(database=name)
@@ -1,20 +1,74 @@
-import weakref
-from bson import DBRef
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+from bson import DBRef, ObjectId
 from copy import copy
-from functools import partial
-from .connection import get_collection, get_database
+from pymongo.errors import BulkWriteError, OperationFailure
+from .aio import submit
+from .compact import FORGETFUL, CompactData, compact_data
+from .connection import get_collection, drop_collection
 from .utils import is_field
 from .fields import ObjectIdField, ValidationError, BaseField
-from .utils import rget_subclasses
+from .identity import IdentityMap
+from .indexes import ensure_indexes, index_name
+from .lazy import LazyData, lazy_data
+from .monitor import operation
+from .parallel import parallel_map
+from .queryset import QuerySet
+from .registry import (collection_types, get_type, ref_type, register,
+                       type_name)
+from .schema import Schema
+
+
+def dereference_many(dbrefs):
+    '''Resolve many :class:`bson.dbref.DBRef` objects with one $in query per
+    collection. Documents already in an identity map are not queried.
+
+    :param dbrefs: Iterable of :class:`bson.dbref.DBRef`.
+    :return: Dictionary of DBRef to :class:`Document`, DBRefs pointing to
+        missing documents are left out.
+    '''
+
+    by_type = defaultdict(set)
+    for dbref in dbrefs:
+        by_type[ref_type(dbref)].add(dbref)
+
+    resolved = {}
+    for doc_type, refs in by_type.iteritems():
+        if doc_type is None:
+            continue
+        missing = {}
+        for dbref in refs:
+            document = doc_type.cached(dbref.id)
+            if document is not None:
+                resolved[dbref] = document
+            else:
+                missing[dbref.id] = dbref
+        if not missing:
+            continue
+        col = doc_type.get_collection()
+        spec = {"_id": {"$in": missing.keys()}}
+        with operation("dereference", doc_type, spec) as op:
+            for doc in col.find(spec):
+                op.add(doc)
+                document = doc_type.decode_type(doc)._load(doc)
+                resolved[missing[doc["_id"]]] = document
+    return resolved
+
 
+BINDINGS = threading.local()
+NOT_WRITTEN = "Not written, an earlier ordered write failed."
 
-def cache_ref_deleted(cls, wref):
-    found = None
-    for _id, ref in cls.__cache__.iteritems():
-        if ref == wref:
-            found = _id
-            break
-    cls.__cache__.pop(found)
+
+def bindings():
+    ''':return: Dictionary of the current thread's :meth:`Document.bind`
+    bindings, :class:`Document` class to (connection, database).'''
+
+    try:
+        return BINDINGS.classes
+    except AttributeError:
+        BINDINGS.classes = {}
+        return BINDINGS.classes
 
 
 class MetaDocument(type):
@@ -22,22 +76,37 @@ class MetaDocument(type):
     Automatically sets :class:`BaseField` name attributes
     to their referenced name.
 
-    :attr _type: :class:`BaseField`(basestring, default=clsname)
+    :attr _type: :class:`BaseField`(basestring, default=clsname), see
+        :func:`mongoom.registry.type_name`
     :attr _id: :class:`ObjectIdField`
-    :attr __cache__: ObjectId to :class:`Document`
-        object hash
+    :attr __cache__: :class:`IdentityMap` of ObjectId to :class:`Document`,
+        sized by the classes _cache_size attribute. Documents of a class
+        bound to another database by :meth:`Document.bind` are keyed by
+        (connection, database, ObjectId), see :meth:`Document.cache_key`.
+    :attr _schema: :class:`Schema` compiled from the class' fields
+    :attr _data_class: Type of the _data of instances, a
+        :class:`CompactData` subclass for compact classes
     '''
 
     def __new__(cls, clsname, bases, attrs):
-        attrs["_type"] = BaseField(basestring, default=clsname)
+        attrs["_type"] = BaseField(
+            basestring, default=type_name(clsname, bases, attrs))
         attrs["_id"] = ObjectIdField()
-        attrs["__cache__"] = {}
+        compact = attrs.get(
+            "_compact", any(getattr(b, "_compact", False) for b in bases))
+        if compact:
+            attrs.setdefault("__slots__", ())
         for name, value in attrs.iteritems():
             if is_field(value):
                 # Set each field's name attribute to their reference name
                 value.__dict__["name"] = name
 
-        return super(MetaDocument, cls).__new__(cls, clsname, bases, attrs)
+        new_cls = super(MetaDocument, cls).__new__(cls, clsname, bases, attrs)
+        new_cls.__cache__ = IdentityMap(getattr(new_cls, "_cache_size", 0))
+        new_cls._schema = Schema(new_cls)
+        new_cls._data_class = compact_data(new_cls) if compact else dict
+        register(new_cls, new_cls.collection()["name"])
+        return new_cls
 
 
 class Document(object):
@@ -47,55 +116,131 @@ class Document(object):
     :param data: MongoDB document.
     :type data: Packed or unpacked dictionary
 
+    Documents are decoded to the class registered under their _type, the
+    class name by default. Classes sharing a name in different modules
+    set an _alias to use instead of the name, or a _namespace that
+    prefixes the names of the class and its subclasses.
+
+    Classes holding millions of documents in memory can set _compact to
+    True. Instances of compact classes and their subclasses have no
+    __dict__ and keep their values in a :class:`CompactData` with a slot
+    per field. They do not memoize decoded values or keep prefetched
+    references alive, and their data property returns a copy.
+
     Usage::
 
         class User(Document):
+            _namespace = "accounts"
             name = Field(basestring)
 
         frank = User(name="Frank").save()
     '''
 
     __metaclass__ = MetaDocument
+    __slots__ = ("_data", "_dirty", "_refs", "_decoded", "_unloaded",
+                 "__weakref__")
+    _cache_size = 0
+    _compact = False
 
     def __init__(self, **data):
-        if "_id" in data and not data["_id"] in self.__cache__:
+        if "_id" in data and \
+                not self.cache_key(data["_id"]) in self.__cache__:
             self.cache(data["_id"])  # Add instance to cache
-        self._data = {}
+        self._setup(self._data_class())
         for name, value in data.iteritems():
             setattr(self, name, value)
-        for name, field in self.fields.iteritems():
-            if field.default is not None:
-                defl = (copy(field.default) if not callable(field.default)
-                        else field.default())
-                self._data.setdefault(name, defl)
+        self.apply_defaults()
+
+    def _setup(self, data, unloaded=frozenset()):
+        self._data = data
+        self._dirty = set()
+        self._unloaded = unloaded
+        if self._compact:
+            self._refs = self._decoded = FORGETFUL
+        else:
+            self._refs = {}
+            self._decoded = {}
 
     @property
     def ref(self):
         '''Returns a DBRef, saves before returning if _id not in data.'''
 
-        if not "_id" in self.data:
+        if not "_id" in self._data:
             self.save()
-        return DBRef(self._type, self._id)
+        return DBRef(self.collection()["name"], self._id)
 
     @property
     def fields(self):
         '''Returns all fields from baseclasses to allow for field
-        inheritence.  Collects fields top down ensuring that fields are
-        properly overriden by subclasses.
+        inheritence.  Fields are collected top down when the class is
+        created, ensuring that fields are properly overriden by subclasses.
+        The returned mapping is shared by all instances, do not modify it.
+        '''
+
+        return self._schema.fields
+
+    def apply_defaults(self, dirty=True):
+        '''Set default values of all fields missing from _data.
+
+        :param dirty: Mark the defaults dirty so they are saved. Documents
+            loaded from the database pass False, so saving them does not
+            write fields nobody set.
         '''
 
-        attrs = {}
-        for obj in reversed(self.__class__.__mro__):
-            attrs.update(obj.__dict__)
-        return dict((k, v) for k, v in attrs.iteritems() if is_field(v))
+        data = self._data
+        unloaded = self._unloaded
+        for name, default in self._schema.copy_defaults:
+            if name not in data and name not in unloaded:
+                data[name] = copy(default)
+                if dirty:
+                    self._mark_dirty(name)
+        for name, default in self._schema.callable_defaults:
+            if name not in data and name not in unloaded:
+                data[name] = default()
+                if dirty:
+                    self._mark_dirty(name)
+
+    @property
+    def unloaded(self):
+        '''Names of fields left out when the document was loaded.'''
+
+        return self._unloaded
+
+    def load(self, *names):
+        '''Fetch fields that were left out when the document was loaded,
+        all of them when no names are given. Fields set since loading are
+        kept, fields the stored document lacks get their defaults.'''
+
+        names = [name for name in names or self._unloaded
+                 if name in self._unloaded]
+        if not names:
+            return
+        col = self.get_collection()
+        doc = col.find_one({"_id": self._id}, dict((n, 1) for n in names))
+        for name in names:
+            if doc and name in doc and name not in self._data:
+                self._data[name] = doc[name]
+        self._unloaded = self._unloaded.difference(names)
+        self.apply_defaults(dirty=False)
+
+    def _missing(self, name):
+        if name not in self._unloaded:
+            raise KeyError(name)
+        self.load(name)
+        return self._data[name]
 
     @property
     def data(self):
         '''The documents data dictionary.
 
-        :getter: Returns the objects _data.
+        :getter: Returns the objects _data, decoding all fields of lazily
+            loaded documents. Compact documents return a dict copy.
         :setter: Updates the objects fields based on the provided dictionary.
         '''
+        if type(self._data) is LazyData:
+            self._data.inflate()
+        elif isinstance(self._data, CompactData):
+            return self._data.copy()
         return self._data
 
     @data.setter
@@ -103,104 +248,469 @@ class Document(object):
         for name, value in data.iteritems():
             setattr(self, name, value)
 
+    def _mark_dirty(self, name):
+        self._dirty.add(name)
+
+    def _owner_for(self, name):
+        ''':return: (dirty set, name) passed to embedded documents and
+        ListFields so they can mark name dirty when they change.'''
+
+        return self._dirty, name
+
+    @property
+    def dirty(self):
+        '''Names of fields changed since the document was last loaded or
+        saved.'''
+
+        return frozenset(self._dirty)
+
+    def changes(self):
+        ''':return: Update document with a $set and $unset of the dirty
+        fields. Empty when nothing changed.'''
+
+        sets, unsets = {}, {}
+        for name in self._dirty:
+            if name == "_id":
+                continue
+            if name in self._data:
+                sets[name] = self._data[name]
+            elif name not in self._unloaded:
+                unsets[name] = ""
+        update = {}
+        if sets:
+            update["$set"] = sets
+        if unsets:
+            update["$unset"] = unsets
+        return update
+
     def cache(self, _id):
         '''Cache a Document object by it's _id field.'''
 
-        self.__cache__[_id] = weakref.ref(
-            self, partial(cache_ref_deleted, self.__class__))
+        self.__cache__.set(self.cache_key(_id), self)
+
+    @classmethod
+    def cache_key(cls, _id):
+        ''':return: Key of _id in __cache__, _id itself unless the class is
+        bound to another database by :meth:`bind` in the current thread.'''
+
+        bound = cls.bound()
+        return _id if bound is None else bound + (_id,)
 
     @classmethod
     def get_cache(cls, _id):
         '''Returns a python object if the _id is in __cache__.'''
 
-        ref = cls.__cache__.get(_id)
-        if ref:
-            return ref()
+        return cls.__cache__.get(cls.cache_key(_id))
+
+    @classmethod
+    def cached(cls, _id):
+        '''Like :meth:`get_cache`, also looking in the caches of subclasses
+        sharing this classes collection.'''
+
+        document = cls.get_cache(_id)
+        if document is None:
+            for subc in collection_types(cls.collection()["name"]):
+                if subc is not cls and issubclass(subc, cls):
+                    document = subc.get_cache(_id)
+                    if document is not None:
+                        break
+        return document
 
     def validate(self):
         '''Ensure all required fields are in _data.'''
 
-        missing_fields = []
-        for name, field in self.fields.iteritems():
-            if field.required and not field.name in self.data:
-                missing_fields.append(field.name)
-
+        missing_fields = [name for name in self._schema.required
+                          if name not in self._data and
+                          name not in self._unloaded]
         if missing_fields:
-            raise ValidationError(
-                "{} missing fields: {}".format(self.name, missing_fields))
+            raise ValidationError("{} missing fields: {}".format(
+                self.__class__.__name__, missing_fields))
 
     def save(self, *args, **kwargs):
-        '''Write _data dict to database.
+        '''Write _data dict to database. New documents are inserted, saved
+        documents are updated with a $set and $unset of their dirty fields
+        only. Nothing is written when no field changed. Fields left out
+        when the document was loaded are never overwritten.
 
         Accepts the same parameters as :meth:`pymongo.collection.insert` and
         :meth:`pymongo.collection.update`'''
 
-        col = get_collection(self.index(), self.collection())
+        col = self.get_collection()
         self.validate()
-        if not "_id" in self.data:  # No id...insert document
-            self._id = col.insert(self.data, *args, **kwargs)
+        if self._unloaded and not "_id" in self._data:
+            raise ValidationError(
+                "Can not insert a partially loaded {}, missing: {}".format(
+                    self.__class__.__name__, sorted(self._unloaded)))
+        if not "_id" in self._data:  # No id...insert document
+            with operation("save", type(self)) as op:
+                self._id = col.insert(self.data, *args, **kwargs)
+                op.add(self._data)
             self.cache(self._id)
+            self._dirty.clear()
             return self
-        col.update({"_id": self._id}, self.data, *args, **kwargs)
+        update = self.changes()
+        if update:
+            spec = {"_id": self._id}
+            with operation("save", type(self), spec) as op:
+                col.update(spec, update, *args, **kwargs)
+                op.add(update)
+            self._dirty.clear()
         return self
 
+    def asave(self, *args, **kwargs):
+        '''Asynchronous :meth:`save`. Runs on the executor of
+        :mod:`mongoom.aio` and returns a :class:`concurrent.futures.Future`
+        of the saved document. Use asyncio.wrap_future to await it from an
+        event loop.'''
+
+        return submit(self.save, *args, **kwargs)
+
+    @classmethod
+    def save_many(cls, docs, ordered=False, batch_size=1000):
+        '''Write many documents using batched bulk operations. Documents
+        without an _id are inserted and get their new _id assigned, all
+        others are upserted.
+
+        :param docs: Iterable of :class:`Document` objects sharing this
+            classes collection.
+        :param ordered: If True, stop at the first document that fails.
+            The documents after it are not written and reported with an
+            :class:`pymongo.errors.OperationFailure`.
+        :param batch_size: Maximum number of writes sent per bulk operation.
+        :return: List of (document, exception) pairs for documents that
+            failed validation or could not be written.
+
+        Usage::
+
+            errors = User.save_many(users)
+        '''
+
+        col = cls.get_collection()
+        errors = []
+        batch = []
+        stopped = False
+        for doc in docs:
+            if stopped:
+                errors.append((doc, OperationFailure(NOT_WRITTEN)))
+                continue
+            try:
+                doc.validate()
+            except ValidationError as e:
+                if ordered and batch:
+                    cls._write_batch(col, batch, ordered, errors)
+                    batch = []
+                errors.append((doc, e))
+                stopped = ordered
+                continue
+            batch.append(doc)
+            if len(batch) >= batch_size:
+                cls._write_batch(col, batch, ordered, errors)
+                batch = []
+                stopped = ordered and bool(errors)
+        if batch:
+            cls._write_batch(col, batch, ordered, errors)
+        return errors
+
+    @classmethod
+    def _write_batch(cls, col, batch, ordered, errors):
+        '''Send one bulk operation for save_many.'''
+
+        if ordered:
+            bulk = col.initialize_ordered_bulk_op()
+        else:
+            bulk = col.initialize_unordered_bulk_op()
+        new = set()
+        ops = []  # Batch index of each queued write
+        for i, doc in enumerate(batch):
+            if "_id" in doc._data:
+                update = doc.changes()
+                if update:
+                    bulk.find({"_id": doc._id}).upsert().update_one(update)
+                    ops.append(i)
+            else:
+                doc._id = ObjectId()
+                new.add(i)
+                bulk.insert(doc.data)
+                ops.append(i)
+
+        failed = {}
+        try:
+            if ops:
+                bulk.execute()
+        except BulkWriteError as e:
+            for err in e.details["writeErrors"]:
+                failed[ops[err["index"]]] = OperationFailure(
+                    err["errmsg"], err["code"], err)
+            if ordered and failed:
+                # Ordered writes stop at the first error
+                first = min(failed)
+                for i in ops:
+                    if i > first:
+                        failed[i] = OperationFailure(NOT_WRITTEN)
+
+        for i, doc in enumerate(batch):
+            if i in failed:
+                errors.append((doc, failed[i]))
+                if i in new:
+                    doc._data.pop("_id")
+            else:
+                if i in new:
+                    doc.cache(doc._id)
+                doc._dirty.clear()
+
     @classmethod
-    def generate_objects(cls, cursor):
+    def generate_objects(cls, cursor, lazy=False, prefetch=None,
+                         batch_size=100, unloaded=None):
         '''Generator that returns all documents from a pymongo cursor as their
         equivalent python class.
 
-        :param cursor: A :class:`pymongo.cursor.Cursor`'''
+        :param cursor: A :class:`pymongo.cursor.Cursor`
+        :param lazy: If True, fields are decoded when first read.
+        :param prefetch: Names of reference fields to resolve for every
+            batch_size documents, see :meth:`prefetch`.
+        :param batch_size: Number of documents per prefetch batch.
+        :param unloaded: Names of fields left out by the cursor's
+            projection.'''
+
+        if not prefetch:
+            for doc in cursor:
+                yield cls._load(doc, lazy, unloaded)
+            return
 
+        batch = []
         for doc in cursor:
-            if doc["_id"] in cls.__cache__:
-                document = cls.get_cache(doc["_id"])
-                document.data = doc
-            else:
-                document = cls(**doc)
-            yield document
+            batch.append(cls._load(doc, lazy, unloaded))
+            if len(batch) >= batch_size:
+                cls.prefetch(batch, prefetch)
+                for document in batch:
+                    yield document
+                batch = []
+        if batch:
+            cls.prefetch(batch, prefetch)
+            for document in batch:
+                yield document
+
+    @classmethod
+    def prefetch(cls, documents, names):
+        '''Resolve the references held by the named fields of many documents
+        using one query per referenced collection. Resolved documents are
+        kept alive by the documents referencing them, so reading the fields
+        later does not query the database.
+
+        :param documents: List of :class:`Document` objects of this class.
+        :param names: Names of :class:`Field` or :class:`ListField`
+            descriptors referencing :class:`Document` classes.
+        '''
+
+        fields = []
+        for name in names:
+            field = cls._schema.get(name)
+            if not getattr(field, "reference", False):
+                raise ValueError(
+                    "{} is not a reference field of {}".format(name, cls))
+            fields.append(field)
+
+        refs = []
+        for document in documents:
+            doc_refs = []
+            for field in fields:
+                value = document._data.get(field.name)
+                if isinstance(value, DBRef):
+                    doc_refs.append(value)
+                elif isinstance(value, list):
+                    doc_refs.extend(v for v in value if isinstance(v, DBRef))
+            refs.append((document, doc_refs))
+
+        resolved = dereference_many(
+            [ref for document, doc_refs in refs for ref in doc_refs])
+        for document, doc_refs in refs:
+            for ref in doc_refs:
+                if ref in resolved:
+                    document._refs[ref] = resolved[ref]
+
+    @classmethod
+    def from_son(cls, doc, unloaded=None):
+        '''Returns a :class:`Document` for a document read from the
+        database. Its values are trusted to be in stored form, so doc is
+        adopted as the object's _data without validating or encoding each
+        field, only missing fields get their defaults. Objects created by
+        users are validated as usual.
+
+        The object is added to the identity map. An object already in the
+        map is refreshed instead: the fields doc holds replace its values
+        and are no longer dirty, other fields are kept. Defaults of fields
+        missing from doc are not dirty.
+
+        :param doc: Dictionary, SON or :class:`LazyData` read from the
+            database, owned by the returned object afterwards.
+        :param unloaded: Names of fields left out by a projection, fetched
+            when first read.
+        '''
+
+        if cls._data_class is not dict:
+            doc = cls._data_class(doc)
+        document = cls.get_cache(doc["_id"])
+        if document is None:
+            document = cls.__new__(cls)
+            document._setup(doc, unloaded or frozenset())
+            document.cache(doc["_id"])
+        else:
+            if document._unloaded:
+                document._unloaded &= unloaded or frozenset()
+            document._dirty.difference_update(
+                [name for name in document._dirty if name in doc])
+            for name, value in document.data.iteritems():
+                if name not in doc:
+                    doc[name] = value
+            document._data = doc
+            document._decoded.clear()
+        document.apply_defaults(dirty=False)
+        return document
+
+    @classmethod
+    def _load(cls, doc, lazy=False, unloaded=None):
+        ''':meth:`from_son` for read paths. Lazy documents wrap raw
+        documents in a :class:`LazyData`, decoding each field the first
+        time it is read.'''
+
+        if lazy:
+            doc = lazy_data(doc)
+        return cls.from_son(doc, unloaded)
 
     @classmethod
-    def find(cls, decode=True, **spec):
-        '''Find objects in a classes collection.
+    def find(cls, decode=True, lazy=False, prefetch=None, only=None,
+             exclude=None, **spec):
+        '''Find objects in a classes collection. Returns a lazy
+        :class:`QuerySet`, refine it with filter, only, order_by, limit,
+        skip, batch_size and hint before iterating it.
 
         :param decode: If True, return :class:`Document`
             objects.
+        :param lazy: If True, documents are backed by undecoded BSON and each
+            field is decoded the first time it is read, see
+            :func:`mongoom.lazy.raw_collection`.
+        :param prefetch: Names of reference fields to resolve in batches
+            while iterating, see :meth:`prefetch`.
+        :param only: Names of the only fields to fetch.
+        :param exclude: Names of fields not to fetch. Fields left out by only
+            or exclude are fetched when first read.
         :param spec: Key, Value pairs to match in mongodb documents.
+
+        Usage::
+
+            for version in Version.find(prefetch=["user"]):
+                print version.user.name  # No query per version
+
+            newest = Version.find(name="master").order_by("-modified").first()
         '''
 
-        col = get_collection(cls.index(), cls.collection())
-        docs = col.find(spec)
-        if not decode:
-            return docs
-        return cls.generate_objects(docs)
+        query = QuerySet(cls, spec, decode, lazy, prefetch)
+        if only:
+            query = query.only(*only)
+        if exclude:
+            query = query.exclude(*exclude)
+        return query
 
     @classmethod
-    def find_one(cls, decode=True, **spec):
+    def find_one(cls, decode=True, lazy=False, only=None, exclude=None,
+                 **spec):
         '''Find one object in a classes collection.
 
         :param decode: If True, return :class:`Document`
             object.
+        :param lazy: If True, decode fields the first time they are read.
+        :param only: Names of the only fields to fetch.
+        :param exclude: Names of fields not to fetch.
         :param spec: Key, Value pairs to match in mongodb documents.
         '''
 
-        col = get_collection(cls.index(), cls.collection())
-        doc = col.find_one(spec)
-        if not decode:
-            return doc
+        return cls.find(decode, lazy, None, only, exclude, **spec).first()
 
-        if doc["_id"] in cls.__cache__:
-            document = cls.get_cache(doc["_id"])
-            document.data = doc
-        else:
-            document = cls(**doc)
-        return document
+    @classmethod
+    def find_arrays(cls, fields, structured=False, string_width=None,
+                    fill=None, **spec):
+        '''Read fields of matching documents into numpy arrays without
+        creating :class:`Document` objects, see :meth:`QuerySet.arrays`.
+        Requires numpy.
+
+        Usage::
+
+            columns = Version.find_arrays(["modified", "size"], name="v1")
+            columns["size"].mean()
+        '''
+
+        return cls.find(**spec).arrays(fields, structured, string_width,
+                                       fill)
+
+    @classmethod
+    def parallel_map(cls, fn, spec=None, processes=None, reduce=None,
+                     initial=None, chunks=4, **options):
+        '''Apply fn to every matching document in worker processes. The
+        matching documents are split into _id ranges of about equal size,
+        each worker process streams its ranges through the normal decoding
+        path with its own connection. fn, reduce and the class must be
+        picklable, that is defined at module level.
+
+        :param fn: Called with each :class:`Document`.
+        :param spec: Query selecting the documents.
+        :param processes: Number of worker processes, one per cpu if None.
+            With 1 everything runs in this process.
+        :param reduce: Fold results with reduce(result, fn(document))
+            starting from initial, per range in the workers and then over
+            the ranges' results. Must accept its own results as second
+            argument, like operator.add.
+        :param initial: Start value of reduce.
+        :param chunks: Number of ranges per process, more ranges balance
+            uneven work better.
+        :param options: lazy, only or exclude, see :meth:`find`.
+        :return: List of fn results in _id order, or the reduced result.
+
+        Usage::
+
+            sizes = Asset.parallel_map(file_size, {"kind": "texture"},
+                                       processes=8, reduce=operator.add,
+                                       initial=0)
+        '''
+
+        return parallel_map(cls, fn, spec, processes, reduce, initial,
+                            chunks, **options)
+
+    @classmethod
+    def afind(cls, *args, **kwargs):
+        '''Asynchronous :meth:`find`, takes the same parameters.
+
+        :return: :class:`concurrent.futures.Future` of a list of all matching
+            documents.
+        '''
+
+        return cls.find(*args, **kwargs).afetch()
+
+    @classmethod
+    def afind_one(cls, *args, **kwargs):
+        '''Asynchronous :meth:`find_one`, takes the same parameters.
+
+        :return: :class:`concurrent.futures.Future` of the document or None.
+        '''
+
+        return submit(cls.find_one, *args, **kwargs)
 
     def remove(self):
         '''Remove Document from database.'''
 
-        col = get_collection(self.index(), self.collection())
-        if "_id" in self.data:
-            col.remove({"_id": self._id})
+        col = self.get_collection()
+        if "_id" in self._data:
+            spec = {"_id": self._id}
+            with operation("remove", type(self), spec) as op:
+                col.remove(spec)
+                op.add()
+
+    def aremove(self):
+        '''Asynchronous :meth:`remove`.
+
+        :return: :class:`concurrent.futures.Future` of None.
+        '''
+
+        return submit(self.remove)
 
     @classmethod
     def index(cls):
@@ -208,27 +718,159 @@ class Document(object):
 
         return getattr(cls, "_index", None)
 
+    @classmethod
+    def indexes(cls):
+        ''':return: List of keyword args of the classes indexes, its
+        _indexes followed by its _index. Each holds a key_or_list and
+        options like unique, sparse, expireAfterSeconds for TTL indexes,
+        partialFilterExpression or name.
+
+        Usage::
+
+            class Session(Document):
+                _indexes = [
+                    {"key_or_list": [("user", 1), ("created", -1)]},
+                    {"key_or_list": "token", "unique": True},
+                    {"key_or_list": "created", "expireAfterSeconds": 3600},
+                    {"key_or_list": "email", "sparse": True},
+                ]
+        '''
+
+        indexes = list(getattr(cls, "_indexes", ()))
+        if cls.index():
+            indexes.append(cls.index())
+        return indexes
+
+    @classmethod
+    def sync_indexes(cls, drop=False):
+        '''Create the indexes declared by the classes stored in this
+        classes collection that the server is missing, and find the
+        indexes on the server none of them declares.
+
+        :param drop: Drop the undeclared indexes.
+        :return: Dictionary with lists of "created" and "extra" index names.
+        '''
+
+        declared = {}
+        for doc_type in collection_types(cls.collection()["name"]) or [cls]:
+            for index in doc_type.indexes():
+                declared.setdefault(index_name(index), index)
+        col = get_collection(None, cls.collection(), *cls.binding())
+        created = ensure_indexes(col, declared.values())
+        extra = sorted(name for name in col.index_information()
+                       if name != "_id_" and name not in declared)
+        if drop:
+            for name in extra:
+                col.drop_index(name)
+        return {"created": sorted(created), "extra": extra}
+
     @classmethod
     def collection(cls):
         ''':return: Keyword args used for collection creation.'''
 
         return getattr(cls, "_collection", {"name": cls.__name__})
 
+    @classmethod
+    def get_collection(cls):
+        ''':return: The classes :class:`pymongo.collection.Collection` in
+        the database it is bound to by its _connection alias and _database
+        name. Both default to the connection made by :func:`connect`.'''
+
+        return get_collection(cls.indexes(), cls.collection(),
+                              *cls.binding())
+
+    @classmethod
+    def bound(cls):
+        ''':return: (connection alias, database name) the current thread
+        bound the class, or a base class, to with :meth:`bind`. None if
+        unbound or the class has a _connection or _database of its own.'''
+
+        bound = bindings()
+        for klass in cls.__mro__:
+            if klass in bound:
+                return bound[klass]
+            if "_connection" in vars(klass) or "_database" in vars(klass):
+                break
+        return None
+
+    @classmethod
+    def binding(cls):
+        ''':return: (connection alias, database name) used by the class in
+        the current thread, see :meth:`bound`. Defaults to its _connection
+        and _database attributes.'''
+
+        bound = cls.bound()
+        if bound is not None:
+            return bound
+        return (getattr(cls, "_connection", None),
+                getattr(cls, "_database", None))
+
+    @classmethod
+    @contextmanager
+    def bind(cls, connection=None, database=None):
+        '''Temporarily bind the class, and subclasses without a binding of
+        their own, to another connection alias or database. The binding
+        only applies to the current thread. Documents loaded while bound
+        have their own identity map entries, the same _id in two databases
+        gives two objects.
+
+        Usage::
+
+            with Event.bind("archive", "events_2015"):
+                Event.find(...)
+        '''
+
+        bound = bindings()
+        saved = bound.get(cls)
+        bound[cls] = (connection or cls.binding()[0], database)
+        try:
+            yield cls
+        finally:
+            if saved is None:
+                del bound[cls]
+            else:
+                bound[cls] = saved
+
+    @classmethod
+    def drop(cls):
+        '''Drop the classes collection. The collection and it's index are
+        created again on the next database operation.'''
+
+        drop_collection(cls.collection()["name"], *cls.binding())
+
     @classmethod
     def dereference(cls, dbref):
-        db = get_database()
-        doc = db.dereference(dbref)
-        doc_type = cls
-        if not doc["_type"] == cls.__name__:
-            for subc in rget_subclasses(cls):
-                if doc["_type"] == subc.__name__:
-                    doc_type = subc
-        if dbref.id in doc_type.__cache__:
-            document = doc_type.get_cache(doc["_id"])
-            document.data = doc
-        else:
-            document = doc_type(**doc)
-        return document
+        '''Returns the :class:`Document` a :class:`bson.dbref.DBRef` points
+        to. Documents in an identity map are returned without a query.'''
+
+        document = cls.cached(dbref.id)
+        if document is not None:
+            return document
+        col = cls.get_collection()
+        spec = {"_id": dbref.id}
+        with operation("dereference", cls, spec) as op:
+            doc = col.find_one(spec)
+            op.add(doc)
+            return cls.decode_type(doc)._load(doc)
+
+    @classmethod
+    def adereference(cls, dbref):
+        '''Asynchronous :meth:`dereference`.
+
+        :return: :class:`concurrent.futures.Future` of the
+            :class:`Document`.
+        '''
+
+        return submit(cls.dereference, dbref)
+
+    @classmethod
+    def decode_type(cls, doc):
+        ''':return: cls or the subclass of cls registered under doc's _type.'''
+
+        doc_type = get_type(doc.get("_type"))
+        if doc_type is not None and issubclass(doc_type, cls):
+            return doc_type
+        return cls
 
 
 class MetaEmbedded(type):
@@ -236,16 +878,22 @@ class MetaEmbedded(type):
     Automatically sets :class:`BaseField` name attributes to
     their referenced name.
 
-    :attr _type: :class:`BaseField`(basestring, default=clsname)
+    :attr _type: :class:`BaseField`(basestring, default=clsname), see
+        :func:`mongoom.registry.type_name`
+    :attr _schema: :class:`Schema` compiled from the class' fields
     '''
 
     def __new__(cls, clsname, bases, attrs):
-        attrs["_type"] = BaseField(basestring, default=clsname)
+        attrs["_type"] = BaseField(
+            basestring, default=type_name(clsname, bases, attrs))
         for name, value in attrs.iteritems():
             if is_field(value):
                 value.__dict__["name"] = name
 
-        return super(MetaEmbedded, cls).__new__(cls, clsname, bases, attrs)
+        new_cls = super(MetaEmbedded, cls).__new__(cls, clsname, bases, attrs)
+        new_cls._schema = Schema(new_cls)
+        register(new_cls)
+        return new_cls
 
 
 class EmbeddedDocument(object):
@@ -278,29 +926,50 @@ class EmbeddedDocument(object):
 
     def __init__(self, **data):
         self._data = data.pop("use_data", {})
+        self._owner = None
+        self._decoded = {}
+        self._refs = {}
         for name, value in data.iteritems():
             setattr(self, name, value)
-        for name, field in self.fields.iteritems():
-            if field.default is not None:
-                defl = (copy(field.default) if not callable(field.default)
-                        else field.default())
-                self._data.setdefault(name, defl)
+        self.apply_defaults()
 
     @property
     def fields(self):
         '''Returns all fields from baseclasses to allow for field
-        inheritence.  Collects fields top down ensuring that fields
-        are properly overriden by subclasses.'''
+        inheritence.  Fields are collected top down when the class is
+        created, ensuring that fields are properly overriden by subclasses.
+        The returned mapping is shared by all instances, do not modify it.
+        '''
 
-        attrs = {}
-        for obj in reversed(self.__class__.__mro__):
-            attrs.update(obj.__dict__)
-        return dict((k, v) for k, v in attrs.iteritems() if is_field(v))
+        return self._schema.fields
+
+    def apply_defaults(self):
+        '''Set default values of all fields missing from _data.'''
+
+        data = self._data
+        for name, default in self._schema.copy_defaults:
+            if name not in data:
+                data[name] = copy(default)
+                self._mark_dirty(name)
+        for name, default in self._schema.callable_defaults:
+            if name not in data:
+                data[name] = default()
+                self._mark_dirty(name)
 
     @property
     def data(self):
         return self._data
 
+    def _missing(self, name):
+        raise KeyError(name)
+
+    def _mark_dirty(self, name):
+        if self._owner:
+            self._owner[0].add(self._owner[1])
+
+    def _owner_for(self, name):
+        return self._owner
+
     @data.setter
     def data(self, data):
         for name, value in data.iteritems():
@@ -308,11 +977,8 @@ class EmbeddedDocument(object):
 
     def validate(self):
         '''Ensure all required fields are in data.'''
-        missing_fields = []
-        for name, field in self.fields.iteritems():
-            if field.required and not field.name in self.data:
-                missing_fields.append(field.name)
-
+        missing_fields = [name for name in self._schema.required
+                          if name not in self._data]
         if missing_fields:
-            raise ValidationError(
-                "{} missing fields: {}".format(self.name, missing_fields))
+            raise ValidationError("{} missing fields: {}".format(
+                self.__class__.__name__, missing_fields))
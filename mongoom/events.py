@@ -1,8 +1,28 @@
+import atexit
+from collections import deque
 from datetime import datetime
+from itertools import groupby
+from threading import Event as ThreadEvent, Lock, Thread
 from .documents import Document
 from .fields import Field
 
 
+PUBLISHER = None
+
+
+def set_publisher(publisher):
+    '''Buffer all fired events in publisher, None fires synchronously.'''
+
+    global PUBLISHER
+    PUBLISHER = publisher
+
+
+def get_publisher():
+    ''':return: The active :class:`Publisher` or None.'''
+
+    return PUBLISHER
+
+
 class Event(Document):
     ''':class:`Event` documents live in a capped mongodb collection.  Allowing
     people to subscribe to events using a tailable cursor.  Inherit from
@@ -19,7 +39,10 @@ class Event(Document):
     @classmethod
     def fire(cls, **data):
         '''A convenience method for firing an event. "Firing an event" is
-        exactly the same as saving an instance of :class:`Event`.
+        exactly the same as saving an instance of :class:`Event`. While a
+        :class:`Publisher` is running the event is buffered and inserted
+        with the next batch instead, otherwise it is saved right away.
+        Invalid events raise a ValidationError either way.
 
         Usage::
 
@@ -27,4 +50,132 @@ class Event(Document):
             Event.fire(ref=doc)
         '''
 
-        cls(**data).save()
+        event = cls(**data)
+        publisher = get_publisher()
+        if publisher is not None and publisher.publish(event):
+            return event
+        return event.save()
+
+
+class Publisher(Thread):
+    '''Buffers fired events and inserts them in batches from a background
+    thread. A batch is flushed once batch_size events are buffered or every
+    interval seconds. Events are written in the order they were fired.
+
+    Buffered events are flushed when the publisher stops, including at
+    interpreter exit. A stopped publisher refuses events, so
+    :meth:`Event.fire` falls back to saving synchronously. When max_buffer
+    events are waiting, the firing thread flushes them itself.
+
+    :param batch_size: Number of buffered events that triggers a flush.
+    :param interval: Longest time in seconds an event stays buffered.
+    :param max_buffer: Number of buffered events that makes fire flush.
+
+    The last 100 failed writes are kept in errors as (event, exception)
+    pairs.
+
+    Usage::
+
+        publisher = Publisher(batch_size=500)
+        publisher.start()
+        set_publisher(publisher)
+        ...
+        Event.fire(ref=doc)
+        ...
+        publisher.stop()
+    '''
+
+    def __init__(self, batch_size=100, interval=0.1, max_buffer=10000):
+        super(Publisher, self).__init__()
+        self.daemon = True
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_buffer = max_buffer
+        self.buffer = deque()
+        self.published = 0
+        self.written = 0
+        self.flushes = 0
+        self.failed = 0
+        self.errors = deque(maxlen=100)
+        self._lock = Lock()
+        self._flushing = Lock()
+        self._wake = ThreadEvent()
+        self._stopped = ThreadEvent()
+
+    def start(self):
+        '''Start the flusher thread and flush remaining events at exit.'''
+
+        super(Publisher, self).start()
+        atexit.register(self.stop)
+
+    def publish(self, event):
+        '''Buffer an unsaved event. The event is validated first, so
+        invalid events raise in the firing thread and are never buffered.
+
+        :raises ValidationError: If the event is missing required fields.
+        :return: False if the publisher is not running, the event should
+            be saved synchronously.
+        '''
+
+        event.validate()
+        with self._lock:
+            if self._stopped.is_set() or not self.is_alive():
+                return False
+            self.buffer.append(event)
+            self.published += 1
+            size = len(self.buffer)
+        if size >= self.max_buffer:
+            self.flush()
+        elif size >= self.batch_size:
+            self._wake.set()
+        return True
+
+    def flush(self):
+        '''Insert all buffered events now.
+
+        :return: Number of events written.
+        '''
+
+        with self._flushing:
+            with self._lock:
+                events = list(self.buffer)
+                self.buffer.clear()
+            if not events:
+                return 0
+            for doc_type, run in groupby(events, type):
+                errors = doc_type.save_many(run, ordered=True)
+                self.failed += len(errors)
+                self.errors.extend(errors)
+            written = sum(1 for event in events if "_id" in event._data)
+            self.written += written
+            self.flushes += 1
+            return written
+
+    def run(self):
+        while not self._stopped.is_set():
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            self.flush()
+        self.flush()
+
+    def stop(self, timeout=None):
+        '''Stop the flusher, writing all buffered events.'''
+
+        with self._lock:
+            self._stopped.set()
+        self._wake.set()
+        if self.is_alive():
+            self.join(timeout)
+        self.flush()
+
+    def stats(self):
+        '''Returns a dictionary of counters: published events, written
+        events, flushes, failed writes and events still buffered.'''
+
+        return {
+            "published": self.published,
+            "written": self.written,
+            "flushes": self.flushes,
+            "failed": self.failed,
+            "buffered": len(self.buffer),
+        }
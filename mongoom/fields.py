@@ -1,7 +1,8 @@
 from bson.objectid import ObjectId
 from bson import DBRef
 from collections import Iterable
-import sys
+from itertools import count
+from .registry import get_type, ref_type
 from .utils import is_document, is_embedded
 
 
@@ -24,8 +25,11 @@ class BaseField(object):
          the name parameter.)
     '''
 
+    _counter = count()
+
     def __init__(self, *types, **kwargs):
         self.name = kwargs.get("name")
+        self.order = next(BaseField._counter)
         self.types = types
         self.default = kwargs.get("default", None)
         self.required = kwargs.get("required", False)
@@ -37,27 +41,45 @@ class BaseField(object):
 
     def __get__(self, inst, cls):
         if inst:
-            return inst._data[self.name]
+            return self.get_data(inst)
         return self
 
     def __set__(self, inst, value):
         self.validate(value)
         inst._data[self.name] = value
+        inst._decoded.pop(self.name, None)
+        inst._mark_dirty(self.name)
+
+    def __delete__(self, inst):
+        del inst._data[self.name]
+        inst._decoded.pop(self.name, None)
+        inst._mark_dirty(self.name)
+
+    def get_data(self, inst):
+        '''Returns the stored value of this field from inst._data. Fields
+        left out by a projection are fetched from the database.'''
+
+        try:
+            return inst._data[self.name]
+        except KeyError:
+            return inst._missing(self.name)
 
     def validate(self, value):
         if not isinstance(value, self.types):
             raise ValidationError(
                 "{} must be of types: {}.".format(self.name, self.types))
 
-    def to_dict(self, value):
+    def to_dict(self, value, owner=None):
         '''Make sure that the value is a dictionary. If value is an
-        :class:`EmbeddedDocument`, pull the documents data.'''
+        :class:`EmbeddedDocument`, pull the documents data and attach the
+        document to owner, so changes to it mark the owner dirty.'''
 
         if not isinstance(value, dict):
+            value._owner = owner
             value = value.data
         return value
 
-    def to_ref(self, value):
+    def to_ref(self, value, owner=None):
         '''Make sure that the value is a :class:`bson.dbref.DBRef`. If value is a
         :class:`Document` object, pull the documents ref.'''
 
@@ -65,23 +87,24 @@ class BaseField(object):
             value = value.ref
         return value
 
-    def from_dict(self, value):
-        '''Decodes a dict object to an :class:`EmbeddedDocument`.'''
+    def from_dict(self, value, owner=None):
+        '''Decodes a dict object to an :class:`EmbeddedDocument`.
+
+        :param owner: (dirty set, field name) tuple of the top-level
+            document holding value.
+        '''
 
-        if "_type" in value:
-            doc_type = self.doc_types.get(
-                value["_type"],
-                getattr(sys.modules["__main__"], value["_type"], None))
-            return doc_type(use_data=value)
+        doc_type = get_type(value.get("_type"))
+        if doc_type is not None:
+            document = doc_type(use_data=value)
+            document._owner = owner
+            return document
         return value
 
-    def from_ref(self, value):
+    def from_ref(self, value, owner=None):
         '''Returns a :class:`Document` from a :class:`bson.dbref.DBRef`.'''
 
-        doc_type = self.doc_types.get(
-            value.collection,
-            getattr(sys.modules["__main__"], value.collection, None))
-        return doc_type.dereference(value)
+        return ref_type(value).dereference(value)
 
 
 class Field(BaseField):
@@ -91,7 +114,8 @@ class Field(BaseField):
     :class:`Document` objects are automatically stored as
     :class:`bson.dbref.DBRef` and decoded back to :class:`Document`. Similarly
     :class:`EmbeddedDocument` objects are stored as dicts and decoded back to
-    :class:`EmbeddedDocument`.
+    :class:`EmbeddedDocument`. Decoded values are kept by the instance until
+    the field is set again or the document is reloaded.
 
     :param types: all args are types for validation
     :param default: default values are copied to inst._data on
@@ -104,8 +128,8 @@ class Field(BaseField):
 
     def __init__(self, *types, **kwargs):
         self.encode, self.decode = None, None
-        self.doc_types = dict((typ.__name__, typ) for typ in types)
-        if all(is_document(typ) for typ in types):
+        self.reference = all(is_document(typ) for typ in types)
+        if self.reference:
             self.encode = self.to_ref
             self.decode = self.from_ref
             types = (DBRef, )
@@ -117,12 +141,18 @@ class Field(BaseField):
 
     def __get__(self, inst, cls):
         if self.decode and inst:
-            return self.decode(inst._data[self.name])
-        super(Field, self).__get__(inst, cls)
+            try:
+                return inst._decoded[self.name]
+            except KeyError:
+                value = self.decode(
+                    self.get_data(inst), inst._owner_for(self.name))
+                inst._decoded[self.name] = value
+                return value
+        return super(Field, self).__get__(inst, cls)
 
     def __set__(self, inst, value):
         if self.encode:
-            value = self.encode(value)
+            value = self.encode(value, inst._owner_for(self.name))
         super(Field, self).__set__(inst, value)
 
 
@@ -144,6 +174,8 @@ class SelfishField(BaseField):
 
     def __init__(self, *types, **kwargs):
         self._value = None
+        self._owner = None
+        self._refs = None
         super(SelfishField, self).__init__(*types, **kwargs)
 
     def __getattr__(self, name):
@@ -151,12 +183,24 @@ class SelfishField(BaseField):
 
     def __get__(self, inst, cls):
         if inst:
-            self._value = inst._data[self.name]
+            self._value = self.get_data(inst)
+            self._owner = inst._owner_for(self.name)
+            self._refs = inst._refs
         return self
 
     def __set__(self, inst, value):
         self._value = value
+        self._owner = inst._owner_for(self.name)
+        self._refs = inst._refs
         inst._data[self.name] = value
+        inst._decoded.pop(self.name, None)
+        inst._mark_dirty(self.name)
+
+    def _mark_dirty(self):
+        '''Mark the field dirty on the document it was last accessed on.'''
+
+        if self._owner:
+            self._owner[0].add(self._owner[1])
 
     @property
     def value(self):
@@ -168,6 +212,9 @@ class ListField(SelfishField):
     descriptor, and the same automatic encoding and decoding of
     :class:`bson.dbref.DBRef` and :class:`EmbeddedDocument`.
 
+    Iterating or slicing a list of references resolves every reference that
+    is not loaded yet with one query per collection.
+
     :param types: all args are types for validation
     :param default: default values are copied to inst._data on
         instantiation, can be a callable.
@@ -180,8 +227,8 @@ class ListField(SelfishField):
     def __init__(self, *types, **kwargs):
         kwargs["default"] = list
         self.encode, self.decode = None, None
-        self.doc_types = dict((typ.__name__, typ) for typ in types)
-        if all(is_document(typ) for typ in types):
+        self.reference = all(is_document(typ) for typ in types)
+        if self.reference:
             self.encode = self.to_ref
             self.decode = self.from_ref
         elif all(is_embedded(typ) for typ in types):
@@ -191,26 +238,63 @@ class ListField(SelfishField):
 
     def __set__(self, inst, value):
         self.validate(value)
+        owner = inst._owner_for(self.name)
         items = []
         for item in value:
             if self.encode:
-                item = self.encode(item)
+                item = self.encode(item, owner)
             items.append(item)
         self._value = items
+        self._owner = owner
+        self._refs = inst._refs
         inst._data[self.name] = items
+        inst._decoded.pop(self.name, None)
+        inst._mark_dirty(self.name)
 
     def __getitem__(self, key):
         value = self._value[key]
+        if self.reference:
+            if isinstance(key, slice):
+                return self.dereference(value)
+            return self.dereference([value])[0]
         if self.decode:
-            value = self.decode(value)
+            if isinstance(key, slice):
+                return [self.decode(item, self._owner) for item in value]
+            value = self.decode(value, self._owner)
         return value
 
+    def __iter__(self):
+        if self.reference:
+            return iter(self.dereference(self._value))
+        if self.decode:
+            return (self.decode(item, self._owner) for item in self._value)
+        return iter(self._value)
+
+    def dereference(self, refs):
+        '''Returns the :class:`Document` objects refs point to, in the same
+        order. References that are not resolved yet are fetched with one
+        $in query per collection. Resolved documents are kept by the
+        document holding the list, missing documents are returned as None.
+        '''
+
+        from .documents import dereference_many
+        resolved = self._refs
+        missing = [ref for ref in refs if ref not in resolved]
+        found = dereference_many(missing) if missing else {}
+        resolved.update(found)
+        return [found.get(ref) or resolved.get(ref) for ref in refs]
+
     def __setitem__(self, key, value):
         if self.encode:
-            value = self.encode(value)
+            value = self.encode(value, self._owner)
         self._value[key] = value
+        self._mark_dirty()
         return self._value
 
+    def __delitem__(self, key):
+        del self._value[key]
+        self._mark_dirty()
+
     def __iadd__(self, value):
         if isinstance(value, Iterable):
             self.extend(value)
@@ -226,9 +310,37 @@ class ListField(SelfishField):
 
     def append(self, value):
         if self.encode:
-            value = self.encode(value)
+            value = self.encode(value, self._owner)
         self._value.append(value)
+        self._mark_dirty()
 
     def extend(self, values):
         for value in values:
             self.append(value)
+
+    def insert(self, index, value):
+        if self.encode:
+            value = self.encode(value, self._owner)
+        self._value.insert(index, value)
+        self._mark_dirty()
+
+    def pop(self, index=-1):
+        value = self._value.pop(index)
+        self._mark_dirty()
+        if self.decode:
+            value = self.decode(value)
+        return value
+
+    def remove(self, value):
+        if self.encode:
+            value = self.encode(value)
+        self._value.remove(value)
+        self._mark_dirty()
+
+    def sort(self, *args, **kwargs):
+        self._value.sort(*args, **kwargs)
+        self._mark_dirty()
+
+    def reverse(self):
+        self._value.reverse()
+        self._mark_dirty()
@@ -0,0 +1,124 @@
+import weakref
+from collections import OrderedDict
+from threading import RLock
+
+
+class IdentityMap(object):
+    '''Maps ObjectIds to live :class:`Document` objects so each database
+    document is represented by at most one python object. Entries are weak
+    references that carry their own key, letting a garbage collected
+    document remove its entry in O(1). An optional LRU of strong references
+    keeps the most recently used documents alive between requests.
+
+    All methods are thread-safe, including removals triggered by the garbage
+    collector.
+
+    :param size: Number of documents kept alive by the LRU, 0 disables it.
+    :attr hits: Number of lookups that found a live document.
+    :attr misses: Number of lookups that did not.
+    :attr evictions: Number of documents dropped from the LRU.
+
+    Usage::
+
+        class User(Document):
+            _cache_size = 1000  # Keep the 1000 last used users alive
+            name = Field(basestring)
+
+        User.__cache__.stats()
+    '''
+
+    def __init__(self, size=0):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._refs = {}
+        self._lru = OrderedDict()
+        self._lock = RLock()
+
+        selfref = weakref.ref(self)
+
+        def remove(wref):
+            imap = selfref()
+            if imap is not None:
+                with imap._lock:
+                    if imap._refs.get(wref.key) is wref:
+                        del imap._refs[wref.key]
+        self._remove = remove
+
+    def __repr__(self):
+        return "<IdentityMap(size={}, len={})>".format(self.size, len(self))
+
+    def __len__(self):
+        return len(self._refs)
+
+    def __contains__(self, key):
+        ref = self._refs.get(key)
+        return ref is not None and ref() is not None
+
+    def get(self, key):
+        ''':return: Live object stored at key or None.'''
+
+        with self._lock:
+            ref = self._refs.get(key)
+            obj = ref() if ref is not None else None
+            if obj is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            if self.size:
+                self._touch(key, obj)
+            return obj
+
+    def set(self, key, obj):
+        '''Store obj at key, replacing any previous entry.'''
+
+        with self._lock:
+            self._refs[key] = weakref.KeyedRef(obj, self._remove, key)
+            if self.size:
+                self._touch(key, obj)
+
+    def pop(self, key):
+        '''Remove key, returns the live object stored at key or None.'''
+
+        with self._lock:
+            self._lru.pop(key, None)
+            ref = self._refs.pop(key, None)
+            return ref() if ref is not None else None
+
+    def clear(self):
+        '''Remove all entries and strong references.'''
+
+        with self._lock:
+            self._refs.clear()
+            self._lru.clear()
+
+    def resize(self, size):
+        '''Change the number of documents kept alive by the LRU.'''
+
+        with self._lock:
+            self.size = size
+            self._evict()
+
+    def stats(self):
+        ''':return: Dictionary of entry counts and lookup counters.'''
+
+        with self._lock:
+            return {
+                "entries": len(self._refs),
+                "strong": len(self._lru),
+                "size": self.size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+    def _touch(self, key, obj):
+        self._lru.pop(key, None)
+        self._lru[key] = obj
+        self._evict()
+
+    def _evict(self):
+        while len(self._lru) > self.size:
+            self._lru.popitem(last=False)
+            self.evictions += 1
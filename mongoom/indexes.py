@@ -0,0 +1,117 @@
+import warnings
+from pymongo import ASCENDING
+from .registry import COLLECTIONS
+
+
+def index_keys(key_or_list):
+    ''':return: List of (key, direction) pairs of an index specification.'''
+
+    if isinstance(key_or_list, basestring):
+        return [(key_or_list, ASCENDING)]
+    return list(key_or_list)
+
+
+def index_name(index):
+    ''':return: The name the server gives an index, its name option or its
+    keys and directions joined by "_", like "name_1_last_name_1".
+
+    :param index: Dictionary matching the signature of
+        :meth:`pymongo.collection.Collection.ensure_index`.
+    '''
+
+    if index.get("name"):
+        return index["name"]
+    return "_".join("{}_{}".format(key, direction)
+                    for key, direction in index_keys(index["key_or_list"]))
+
+
+def ensure_indexes(collection, indexes, ensured=None):
+    '''Create the indexes the collection is missing. Asks the server for
+    its indexes only if some are not in ensured.
+
+    :param collection: :class:`pymongo.collection.Collection`
+    :param indexes: List of index dictionaries, see :func:`index_name`.
+    :param ensured: Set of index names known to exist, updated.
+    :return: Names of the created indexes.
+    '''
+
+    ensured = set() if ensured is None else ensured
+    missing = [index for index in indexes if index_name(index) not in ensured]
+    if not missing:
+        return []
+    existing = collection.index_information()
+    created = []
+    for index in missing:
+        name = index_name(index)
+        if name not in existing:
+            collection.ensure_index(**index)
+            created.append(name)
+        ensured.add(name)
+    return created
+
+
+def sync_indexes(doc_types=None, drop=False):
+    '''Create missing indexes and report indexes nobody declared for the
+    collections of doc_types, see :meth:`Document.sync_indexes`. Extra
+    indexes are reported with a RuntimeWarning. Run it once at startup.
+
+    :param doc_types: :class:`Document` classes, all registered classes
+        declaring indexes if None.
+    :param drop: Drop the extra indexes.
+    :return: Dictionary of collection name to a dictionary with the
+        "created" and "extra" index names.
+    '''
+
+    if doc_types is None:
+        doc_types = [classes[0] for classes in COLLECTIONS.values()
+                     if any(doc_type.indexes() for doc_type in classes)]
+    report = {}
+    for doc_type in doc_types:
+        name = doc_type.collection()["name"]
+        report[name] = result = doc_type.sync_indexes(drop)
+        if result["extra"]:
+            warnings.warn(
+                "Collection {} has undeclared indexes {}{}.".format(
+                    name, ", ".join(result["extra"]),
+                    ", dropped" if drop else ""), RuntimeWarning)
+    return report
+
+
+def collection_scan(plan):
+    '''True if the winning plan of an explain result scans the whole
+    collection, a COLLSCAN stage or a BasicCursor before MongoDB 3.0.'''
+
+    if "queryPlanner" in plan:
+        plan = plan["queryPlanner"].get("winningPlan", {})
+    if isinstance(plan, dict):
+        if plan.get("stage") == "COLLSCAN" or \
+                plan.get("cursor") == "BasicCursor":
+            return True
+        return any(collection_scan(value)
+                   for key, value in plan.iteritems()
+                   if key != "rejectedPlans" and
+                   isinstance(value, (dict, list)))
+    if isinstance(plan, list):
+        return any(collection_scan(value) for value in plan)
+    return False
+
+
+def check_queries(queries):
+    '''Explain each :class:`QuerySet` and warn about those scanning their
+    whole collection. Meant for the hot queries of an application, in
+    tests or at startup.
+
+    :return: List of the queries scanning collections.
+
+    Usage::
+
+        check_queries([Version.find(name="v1"), User.find(last_name="Foo")])
+    '''
+
+    scans = []
+    for query in queries:
+        if query.scans_collection():
+            scans.append(query)
+            warnings.warn("{!r} scans the whole collection.".format(query),
+                          RuntimeWarning)
+    return scans
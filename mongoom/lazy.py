@@ -0,0 +1,280 @@
+import struct
+from inspect import getargspec
+from threading import Lock
+import pymongo
+from bson import BSON
+from bson.errors import InvalidBSON
+from pymongo import helpers
+try:
+    from bson.codec_options import CodecOptions
+    from bson.raw_bson import RawBSONDocument
+except ImportError:
+    CodecOptions = RawBSONDocument = None
+
+
+_INT32 = struct.Struct("<i")
+_FIXED_SIZES = {
+    "\x01": 8,   # double
+    "\x06": 0,   # undefined
+    "\x07": 12,  # ObjectId
+    "\x08": 1,   # boolean
+    "\x09": 8,   # datetime
+    "\x0A": 0,   # null
+    "\x10": 4,   # int32
+    "\x11": 8,   # timestamp
+    "\x12": 8,   # int64
+    "\x13": 16,  # decimal128
+    "\xFF": 0,   # min key
+    "\x7F": 0,   # max key
+}
+_SIZED = frozenset(["\x03", "\x04", "\x0F"])  # document, array, code w scope
+_STRINGS = frozenset(["\x02", "\x0D", "\x0E"])  # string, code, symbol
+
+
+def element_offsets(raw):
+    '''Scan the top-level elements of a BSON document without decoding
+    their values.
+
+    :param raw: BSON encoded document.
+    :return: Dictionary of element name to (start, end) offsets in raw.
+    '''
+
+    offsets = {}
+    position = 4
+    end = len(raw) - 1
+    while position < end:
+        start = position
+        kind = raw[position]
+        name_end = raw.index("\x00", position + 1)
+        name = raw[position + 1:name_end].decode("utf-8")
+        position = name_end + 1
+        if kind in _FIXED_SIZES:
+            position += _FIXED_SIZES[kind]
+        elif kind in _SIZED:
+            position += _INT32.unpack_from(raw, position)[0]
+        elif kind in _STRINGS:
+            position += 4 + _INT32.unpack_from(raw, position)[0]
+        elif kind == "\x05":  # binary, length + subtype + data
+            position += 5 + _INT32.unpack_from(raw, position)[0]
+        elif kind == "\x0B":  # regex, pattern and flags cstrings
+            position = raw.index("\x00", raw.index("\x00", position) + 1) + 1
+        elif kind == "\x0C":  # dbpointer, string + ObjectId
+            position += 16 + _INT32.unpack_from(raw, position)[0]
+        else:
+            raise InvalidBSON(
+                "Unknown element type {!r} for {}".format(kind, name))
+        offsets[name] = (start, position)
+    return offsets
+
+
+def decode_element(raw, start, end):
+    ''':return: Decoded value of the element at raw[start:end].'''
+
+    element = raw[start:end]
+    doc = BSON(_INT32.pack(len(element) + 5) + element + "\x00").decode()
+    return doc.popitem()[1]
+
+
+def _inflating(method):
+    def inflating(self, *args, **kwargs):
+        if self._offsets is None or self._offsets:
+            self.inflate()
+        return method(self, *args, **kwargs)
+    inflating.__name__ = method.__name__
+    return inflating
+
+
+class LazyData(dict):
+    '''A dict of a document's fields that decodes each field from raw BSON
+    the first time it is read. Decoded values are kept, so a field is only
+    ever decoded once. Methods that need every field, like iteration,
+    decode all remaining fields first.
+
+    Code reading the dict directly, like dict(data) or the BSON encoder,
+    only sees decoded fields. Call :meth:`inflate` before handing it over.
+
+    :param raw: BSON encoded document.
+    '''
+
+    __slots__ = ("_raw", "_offsets")
+
+    def __init__(self, raw):
+        super(LazyData, self).__init__()
+        self._raw = raw
+        self._offsets = None
+
+    def __repr__(self):
+        return "<LazyData({}, pending={})>".format(
+            dict.__repr__(self), sorted(self._pending()))
+
+    def _pending(self):
+        if self._offsets is None:
+            self._offsets = element_offsets(self._raw)
+        return self._offsets
+
+    def __missing__(self, key):
+        offsets = self._pending()
+        if key not in offsets:
+            raise KeyError(key)
+        value = decode_element(self._raw, *offsets.pop(key))
+        dict.__setitem__(self, key, value)
+        return value
+
+    def __contains__(self, key):
+        return dict.__contains__(self, key) or key in self._pending()
+
+    def __setitem__(self, key, value):
+        self._pending().pop(key, None)
+        dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        if self._pending().pop(key, None) is None:
+            dict.__delitem__(self, key)
+        else:
+            dict.pop(self, key, None)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    @property
+    def pending(self):
+        '''Names of fields that have not been decoded yet.'''
+
+        return frozenset(self._pending())
+
+    def inflate(self):
+        '''Decode all remaining fields.'''
+
+        for key in list(self._pending()):
+            self.__missing__(key)
+
+    for _name in ("__iter__", "__len__", "__eq__", "__ne__", "keys",
+                  "values", "items", "iterkeys", "itervalues", "iteritems",
+                  "copy", "pop", "popitem", "setdefault", "update", "clear",
+                  "has_key"):
+        locals()[_name] = _inflating(getattr(dict, _name))
+    del _name
+
+
+class RawDocument(object):
+    '''An undecoded document read by drivers without RawBSONDocument,
+    see :func:`raw_collection`.
+
+    :attr raw: BSON encoded document.
+    '''
+
+    __slots__ = ("raw",)
+
+    def __init__(self, raw=None):
+        self.raw = raw
+
+
+def split_documents(data):
+    ''':return: List of :class:`RawDocument` of concatenated BSON
+    documents, without decoding them.'''
+
+    documents = []
+    position = 0
+    while position < len(data):
+        size = _INT32.unpack_from(data, position)[0]
+        documents.append(RawDocument(data[position:position + size]))
+        position += size
+    return documents
+
+
+_unpack_response = None
+_PATCH_LOCK = Lock()
+_UNPACK_ARGS = ["response", "cursor_id", "as_class"]
+
+
+def _unpack_raw_response(response, cursor_id=None, as_class=dict, *args,
+                         **kwargs):
+    '''pymongo.helpers._unpack_response, returning undecoded documents
+    for cursors of :class:`RawDocument`. Errors, flagged in the first
+    two bits of the response, are raised by pymongo.'''
+
+    if as_class is not RawDocument or _INT32.unpack_from(response)[0] & 3:
+        return _unpack_response(response, cursor_id, as_class, *args,
+                                **kwargs)
+    return {
+        "cursor_id": struct.unpack("<q", response[4:12])[0],
+        "starting_from": _INT32.unpack_from(response, 12)[0],
+        "number_returned": _INT32.unpack_from(response, 16)[0],
+        "data": split_documents(response[20:]),
+    }
+
+
+class RawCollection(object):
+    '''Wraps a collection of a driver without RawBSONDocument, its find
+    and find_one return :class:`RawDocument` objects.'''
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    def __getattr__(self, name):
+        return getattr(self.collection, name)
+
+    def find(self, *args, **kwargs):
+        kwargs["as_class"] = RawDocument
+        return self.collection.find(*args, **kwargs)
+
+    def find_one(self, *args, **kwargs):
+        kwargs["as_class"] = RawDocument
+        return self.collection.find_one(*args, **kwargs)
+
+
+def install_raw_replies():
+    '''Wrap pymongo.helpers._unpack_response, where cursors of pymongo
+    2.x decode replies, so cursors of :class:`RawDocument` keep them
+    undecoded. Other cursors are not affected. Done on the first call of
+    :func:`raw_collection`.
+
+    :raises RuntimeError: If pymongo is not 2.x or _unpack_response does
+        not take (response, cursor_id, as_class, ...).
+    '''
+
+    global _unpack_response
+    with _PATCH_LOCK:
+        unpack = helpers._unpack_response
+        if unpack is _unpack_raw_response:
+            return
+        try:
+            args = getargspec(unpack).args
+        except TypeError:
+            args = []
+        if pymongo.version_tuple[0] != 2 or args[:3] != _UNPACK_ARGS:
+            raise RuntimeError(
+                "Lazy documents are not supported with pymongo {}, "
+                "use pymongo 2.x or a driver with "
+                "RawBSONDocument.".format(pymongo.version))
+        _unpack_response = unpack
+        helpers._unpack_response = _unpack_raw_response
+
+
+def lazy_data(doc):
+    '''Returns a :class:`LazyData` for a RawBSONDocument or
+    :class:`RawDocument`, other documents are returned unchanged.'''
+
+    raw = getattr(doc, "raw", None)
+    if raw is None:
+        return doc
+    return LazyData(raw)
+
+
+def raw_collection(collection):
+    '''Returns collection configured to return RawBSONDocuments, or a
+    :class:`RawCollection` returning :class:`RawDocument` objects for
+    drivers without RawBSONDocument, like pymongo 2.x, see
+    :func:`install_raw_replies`.'''
+
+    if RawBSONDocument is None:
+        install_raw_replies()
+        return RawCollection(collection)
+    options = collection.codec_options
+    return collection.with_options(codec_options=CodecOptions(
+        document_class=RawBSONDocument,
+        tz_aware=options.tz_aware,
+        uuid_representation=options.uuid_representation))
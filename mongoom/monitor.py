@@ -0,0 +1,297 @@
+from bisect import bisect_left
+from threading import Lock
+from time import time
+from bson import BSON
+from bson.errors import InvalidDocument
+
+
+LISTENERS = []
+SIZES = []
+
+
+def add_listener(listener, sizes=False):
+    '''Call listener with every finished :class:`Operation`. Listeners run
+    on the thread that did the operation and must be fast and thread-safe.
+    While no listener is installed operations are not measured at all.
+
+    :param sizes: Measure the byte size of decoded documents by encoding
+        them again, which costs about as much as decoding. Raw documents,
+        as read by lazy finds, are always measured.
+    '''
+
+    if listener not in LISTENERS:
+        LISTENERS.append(listener)
+    if sizes and listener not in SIZES:
+        SIZES.append(listener)
+
+
+def remove_listener(listener):
+    if listener in LISTENERS:
+        LISTENERS.remove(listener)
+    if listener in SIZES:
+        SIZES.remove(listener)
+
+
+def spec_shape(spec):
+    ''':return: A query's structure with all values replaced by "?", keys
+    sorted, usable as a low cardinality label.
+
+    Usage::
+
+        >>> spec_shape({"name": "Frank", "age": {"$gt": 30}})
+        '{age: {$gt: ?}, name: ?}'
+    '''
+
+    if isinstance(spec, dict):
+        return "{" + ", ".join(
+            "{}: {}".format(key, spec_shape(spec[key]))
+            for key in sorted(spec)) + "}"
+    if isinstance(spec, (list, tuple)) and spec and \
+            all(isinstance(item, dict) for item in spec):
+        return "[" + ", ".join(spec_shape(item) for item in spec) + "]"
+    return "?"
+
+
+def document_size(doc, encode=True):
+    ''':return: BSON size of a document in bytes. Raw documents are
+    measured without encoding, others are encoded if encode is True and
+    measure 0 otherwise.'''
+
+    raw = getattr(doc, "raw", None) or getattr(doc, "_raw", None)
+    if raw is not None:
+        return len(raw)
+    if not encode:
+        return 0
+    if not isinstance(doc, dict):
+        doc = dict(doc.iteritems())
+    try:
+        return len(BSON.encode(doc))
+    except (InvalidDocument, TypeError):
+        return 0
+
+
+class Operation(object):
+    '''A timed database operation handed to listeners when it finishes.
+
+    :attr name: "save", "find", "find_one", "remove", "dereference",
+        "get_collection" or "dispatch".
+    :attr doc_type: Name of the :class:`Document` class, or the collection
+        name for get_collection.
+    :attr shape: :func:`spec_shape` of the query or None.
+    :attr count: Number of documents read or written.
+    :attr bytes: BSON size of those documents, decoded documents count
+        only while a listener asked for sizes, see :func:`add_listener`.
+    :attr seconds: Time spent in the operation.
+    :attr error: True if the operation raised.
+    '''
+
+    __slots__ = ("name", "doc_type", "shape", "count", "bytes", "seconds",
+                 "error", "_start")
+
+    def __init__(self, name, doc_type=None, spec=None):
+        self.name = name
+        self.doc_type = getattr(doc_type, "__name__", doc_type)
+        self.shape = None if spec is None else spec_shape(spec)
+        self.count = 0
+        self.bytes = 0
+        self.seconds = 0.0
+        self.error = False
+
+    def __repr__(self):
+        return "<Operation({}, {}, {}, count={}, seconds={:.6f})>".format(
+            self.name, self.doc_type, self.shape, self.count, self.seconds)
+
+    def __enter__(self):
+        self._start = time()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.seconds += time() - self._start
+        self.error = exc_type is not None
+        self.emit()
+
+    def add(self, doc=None):
+        '''Count a document read or written.'''
+
+        self.count += 1
+        if doc is not None:
+            self.bytes += document_size(doc, bool(SIZES))
+
+    def emit(self):
+        for listener in LISTENERS:
+            listener(self)
+
+
+class NoOperation(object):
+    '''Returned by :func:`operation` while nobody listens.'''
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        pass
+
+    def add(self, doc=None):
+        pass
+
+
+NO_OPERATION = NoOperation()
+
+
+def operation(name, doc_type=None, spec=None):
+    '''Context manager timing an operation.
+
+    Usage::
+
+        with operation("save", type(doc), spec) as op:
+            ...
+            op.add(data)
+    '''
+
+    if not LISTENERS:
+        return NO_OPERATION
+    return Operation(name, doc_type, spec)
+
+
+def monitored(name, doc_type, spec, iterable, data=None):
+    '''Wrap an iterable of query results, timing only the time spent
+    producing results. The operation is emitted once the iterable is
+    exhausted or closed.
+
+    :param data: Function returning the stored data of a result.
+    '''
+
+    if not LISTENERS:
+        return iterable
+    return _monitored(Operation(name, doc_type, spec), iter(iterable), data)
+
+
+def _monitored(op, iterator, data):
+    try:
+        while True:
+            start = time()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                op.seconds += time() - start
+                return
+            op.seconds += time() - start
+            op.add(data(item) if data else item)
+            yield item
+    except Exception:
+        op.error = True
+        raise
+    finally:
+        op.emit()
+
+
+class StatsCollector(object):
+    '''Listener aggregating operations per operation name and class into
+    latency histograms, document, byte and error counters.
+
+    Usage::
+
+        stats = StatsCollector()
+        add_listener(stats, sizes=True)
+        ...
+        print stats.prometheus()
+    '''
+
+    buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+               0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, buckets=None):
+        if buckets:
+            self.buckets = tuple(sorted(buckets))
+        self.operations = {}
+        self._lock = Lock()
+
+    def __call__(self, op):
+        key = (op.name, op.doc_type or "")
+        with self._lock:
+            stat = self.operations.get(key)
+            if stat is None:
+                stat = self.operations[key] = {
+                    "count": 0, "seconds": 0.0, "documents": 0, "bytes": 0,
+                    "errors": 0, "buckets": [0] * (len(self.buckets) + 1)}
+            stat["count"] += 1
+            stat["seconds"] += op.seconds
+            stat["documents"] += op.count
+            stat["bytes"] += op.bytes
+            stat["errors"] += op.error
+            stat["buckets"][bisect_left(self.buckets, op.seconds)] += 1
+
+    def reset(self):
+        with self._lock:
+            self.operations.clear()
+
+    def identity_maps(self):
+        ''':return: Dictionary of class name to identity map entries.'''
+
+        from .registry import TYPES
+        return dict((name, len(cls.__cache__))
+                    for name, cls in TYPES.items()
+                    if hasattr(cls, "__cache__"))
+
+    def as_dict(self):
+        '''Returns a dictionary with two keys:
+
+            * operations: {name: {class name: stats}}, stats hold count,
+              seconds, documents, bytes, errors and buckets, a list of
+              (upper bound, cumulative count) pairs
+            * identity_maps: {class name: entries}
+        '''
+
+        operations = {}
+        with self._lock:
+            for (name, doc_type), stat in self.operations.iteritems():
+                stat = dict(stat)
+                cumulative, total = [], 0
+                for bound, num in zip(self.buckets + (float("inf"),),
+                                      stat["buckets"]):
+                    total += num
+                    cumulative.append((bound, total))
+                stat["buckets"] = cumulative
+                operations.setdefault(name, {})[doc_type] = stat
+        return {"operations": operations,
+                "identity_maps": self.identity_maps()}
+
+    def prometheus(self, prefix="mongoom"):
+        ''':return: Statistics in the Prometheus text exposition format.'''
+
+        stats = self.as_dict()
+        lines = [
+            "# HELP {}_operation_seconds Latency of operations.".format(prefix),
+            "# TYPE {}_operation_seconds histogram".format(prefix)]
+        counters = []
+        for name, by_type in sorted(stats["operations"].items()):
+            for doc_type, stat in sorted(by_type.items()):
+                labels = 'operation="{}",document="{}"'.format(
+                    escape(name), escape(doc_type))
+                for bound, total in stat["buckets"]:
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append('{}_operation_seconds_bucket{{{},le="{}"}} {}'
+                                 .format(prefix, labels, le, total))
+                lines.append("{}_operation_seconds_sum{{{}}} {!r}".format(
+                    prefix, labels, stat["seconds"]))
+                lines.append("{}_operation_seconds_count{{{}}} {}".format(
+                    prefix, labels, stat["count"]))
+                for counter in ("documents", "bytes", "errors"):
+                    counters.append((counter, labels, stat[counter]))
+        for counter in ("documents", "bytes", "errors"):
+            lines.append("# TYPE {}_operation_{}_total counter".format(
+                prefix, counter))
+            lines.extend("{}_operation_{}_total{{{}}} {}".format(
+                prefix, counter, labels, value)
+                for name, labels, value in counters if name == counter)
+        lines.append("# TYPE {}_identity_map_entries gauge".format(prefix))
+        for doc_type, entries in sorted(stats["identity_maps"].items()):
+            lines.append('{}_identity_map_entries{{document="{}"}} {}'.format(
+                prefix, escape(doc_type), entries))
+        return "\n".join(lines) + "\n"
+
+
+def escape(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
@@ -0,0 +1,84 @@
+from multiprocessing import Pool, cpu_count
+from .connection import after_fork
+
+
+def id_ranges(query, num):
+    '''Split the documents of a :class:`QuerySet` into at most num ranges
+    of about equal size.
+
+    :return: List of (low, high) _id pairs, low is inclusive and high
+        exclusive, None means unbounded.
+    '''
+
+    total = query.count()
+    if not total:
+        return []
+    num = max(1, min(num, total))
+    ids = query.order_by("_id")
+    bounds = [None]
+    for i in xrange(1, num):
+        for doc in ids.skip(total * i // num).limit(1):
+            if doc["_id"] != bounds[-1]:
+                bounds.append(doc["_id"])
+    bounds.append(None)
+    return zip(bounds[:-1], bounds[1:])
+
+
+def range_spec(spec, low, high):
+    ''':return: spec restricted to _ids in [low, high).'''
+
+    bounds = {}
+    if low is not None:
+        bounds["$gte"] = low
+    if high is not None:
+        bounds["$lt"] = high
+    if not bounds:
+        return dict(spec)
+    if "_id" in spec:
+        return {"$and": [spec, {"_id": bounds}]}
+    return dict(spec, _id=bounds)
+
+
+def map_range(args):
+    '''Worker: apply fn to every document of one _id range, in _id
+    order.'''
+
+    doc_type, fn, spec, options, reduce, initial = args
+    documents = (doc_type.find(**options).filter(**spec)
+                 .order_by("_id").batch_size(1000))
+    if reduce is None:
+        return [fn(document) for document in documents]
+    result = initial
+    for document in documents:
+        result = reduce(result, fn(document))
+    return result
+
+
+def parallel_map(doc_type, fn, spec=None, processes=None, reduce=None,
+                 initial=None, chunks=4, **options):
+    '''Apply fn to every matching document in worker processes. See
+    :meth:`Document.parallel_map`.'''
+
+    spec = spec or {}
+    processes = processes or cpu_count()
+    query = doc_type.find(decode=False).filter(**spec).only("_id")
+    ranges = id_ranges(query, processes * chunks)
+    tasks = [(doc_type, fn, range_spec(spec, low, high), options, reduce,
+              initial) for low, high in ranges]
+
+    if processes == 1:
+        parts = [map_range(task) for task in tasks]
+    else:
+        pool = Pool(processes, initializer=after_fork)
+        try:
+            parts = pool.map(map_range, tasks, chunksize=1)
+        finally:
+            pool.terminate()
+            pool.join()
+
+    if reduce is None:
+        return [result for part in parts for result in part]
+    result = initial
+    for part in parts:
+        result = reduce(result, part)
+    return result
@@ -0,0 +1,266 @@
+from copy import copy
+from operator import attrgetter
+from pymongo import ASCENDING, DESCENDING
+from .aio import Batches, fetch, submit
+from .arrays import field_dtype, to_arrays
+from .indexes import collection_scan
+from .lazy import raw_collection
+from .monitor import monitored
+
+
+class QuerySet(object):
+    '''A lazy query on a :class:`Document` classes collection. Each method
+    returns a new QuerySet, nothing is sent to the server until the
+    QuerySet is iterated, counted or asked for its first document. Limit,
+    skip, sort, projection, batch size and hint are all applied by the
+    server.
+
+    :param doc_type: :class:`Document` class to query.
+    :param spec: Key, Value pairs to match in mongodb documents.
+    :param decode: If True, iterate :class:`Document` objects, otherwise
+        iterate the documents returned by pymongo.
+    :param lazy: If True, decode fields the first time they are read.
+    :param prefetch: Names of reference fields to resolve in batches.
+
+    Usage::
+
+        latest = (Version.find(user=frank.ref)
+                  .order_by("-modified")
+                  .limit(10))
+        for version in latest:
+            print version.name
+    '''
+
+    def __init__(self, doc_type, spec=None, decode=True, lazy=False,
+                 prefetch=None):
+        self.doc_type = doc_type
+        self.spec = dict(spec or {})
+        self._decode = decode
+        self._lazy = lazy
+        self._prefetch = prefetch
+        self._projection = None
+        self._unloaded = None
+        self._sort = []
+        self._limit = 0
+        self._skip = 0
+        self._batch_size = 0
+        self._hint = None
+
+    def __repr__(self):
+        return "<QuerySet({}, {})>".format(self.doc_type.__name__, self.spec)
+
+    def __iter__(self):
+        return self._iterate("find")
+
+    def _iterate(self, name):
+        '''Iterate results, reported to monitor listeners as name.'''
+
+        cursor = self.cursor()
+        if not self._decode:
+            return monitored(name, self.doc_type, self.spec, cursor)
+        documents = self.doc_type.generate_objects(
+            cursor, self._lazy, self._prefetch, self._batch_size or 100,
+            self._unloaded)
+        return monitored(name, self.doc_type, self.spec, documents,
+                         attrgetter("_data"))
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start = key.start or 0
+            stop = key.stop
+            if (key.step not in (None, 1) or start < 0 or
+                    (stop is not None and stop < 0)):
+                raise IndexError("QuerySet slices must be positive.")
+            # Slices apply within an existing limit, limit(0) means none
+            limit = None if stop is None else stop - start
+            if self._limit:
+                remaining = self._limit - start
+                limit = remaining if limit is None else min(limit, remaining)
+            if limit is not None and limit <= 0:
+                return self.none()
+            qs = self.skip(self._skip + start)
+            if limit is not None:
+                qs = qs.limit(limit)
+            return qs
+        if key < 0:
+            raise IndexError("QuerySet indexes must be positive.")
+        if self._limit and key >= self._limit:
+            raise IndexError("QuerySet index out of range.")
+        document = self.skip(self._skip + key).first()
+        if document is None:
+            raise IndexError("QuerySet index out of range.")
+        return document
+
+    def _clone(self, **attrs):
+        qs = copy(self)
+        qs.spec = dict(self.spec)
+        qs._sort = list(self._sort)
+        qs.__dict__.update(attrs)
+        return qs
+
+    def filter(self, **spec):
+        '''Match additional Key, Value pairs.'''
+
+        qs = self._clone()
+        qs.spec.update(spec)
+        return qs
+
+    def none(self):
+        '''Match no documents.'''
+
+        nothing = {"_id": {"$in": []}}
+        return self._clone(
+            spec={"$and": [self.spec, nothing]} if self.spec else nothing)
+
+    def only(self, *names):
+        '''Only fetch the named fields from the server. The other fields
+        of the decoded documents are fetched when first read.'''
+
+        names = set(names) | set(["_id", "_type"])
+        unloaded = frozenset(self.doc_type._schema.names).difference(names)
+        projection = dict((name, 1) for name in names)
+        return self._clone(_projection=projection, _unloaded=unloaded)
+
+    def exclude(self, *names):
+        '''Do not fetch the named fields from the server. They are fetched
+        when first read.'''
+
+        unloaded = frozenset(names).difference(["_id", "_type"])
+        projection = dict((name, 0) for name in unloaded)
+        return self._clone(_projection=projection, _unloaded=unloaded)
+
+    def order_by(self, *keys):
+        '''Sort by field names, prefix a name with "-" to sort descending.'''
+
+        sort = []
+        for key in keys:
+            if key.startswith("-"):
+                sort.append((key[1:], DESCENDING))
+            else:
+                sort.append((key.lstrip("+"), ASCENDING))
+        return self._clone(_sort=sort)
+
+    def limit(self, num):
+        '''Return at most num documents.'''
+
+        return self._clone(_limit=num)
+
+    def skip(self, num):
+        '''Skip the first num documents.'''
+
+        return self._clone(_skip=num)
+
+    def batch_size(self, num):
+        '''Number of documents the server returns per batch.'''
+
+        return self._clone(_batch_size=num)
+
+    def hint(self, index):
+        '''Force the server to use index, a list of (key, direction) pairs.'''
+
+        return self._clone(_hint=index)
+
+    def explain(self):
+        ''':return: The server's explain output for this query.'''
+
+        return self.cursor().explain()
+
+    def scans_collection(self):
+        '''True if the server answers this query by scanning the whole
+        collection instead of using an index.'''
+
+        return collection_scan(self.explain())
+
+    def cursor(self):
+        ''':return: A new :class:`pymongo.cursor.Cursor` for this query.'''
+
+        doc_type = self.doc_type
+        col = doc_type.get_collection()
+        if self._lazy:
+            col = raw_collection(col)
+        cursor = col.find(self.spec, self._projection)
+        if self._sort:
+            cursor = cursor.sort(self._sort)
+        if self._skip:
+            cursor = cursor.skip(self._skip)
+        if self._limit:
+            cursor = cursor.limit(self._limit)
+        if self._batch_size:
+            cursor = cursor.batch_size(self._batch_size)
+        if self._hint:
+            cursor = cursor.hint(self._hint)
+        return cursor
+
+    def count(self, with_limit_and_skip=False):
+        ''':return: Number of matching documents, counted by the server.'''
+
+        return self.cursor().count(with_limit_and_skip)
+
+    def first(self):
+        ''':return: The first matching document or None.'''
+
+        for document in self.limit(1)._iterate("find_one"):
+            return document
+
+    def arrays(self, fields, structured=False, string_width=None,
+               fill=None):
+        '''Read the named fields of all matching documents into numpy
+        arrays, preallocated from the server's count and filled batch by
+        batch. No :class:`Document` objects are created. Dtypes follow the
+        fields' types, see :func:`mongoom.arrays.field_dtype`. Missing
+        values are NaN, NaT or None depending on the dtype. Bool, int and
+        string arrays with missing values are masked arrays instead.
+
+        :param fields: Names of the fields to read.
+        :param structured: Return a structured array instead of a dict.
+        :param string_width: Read string fields into fixed width unicode
+            arrays of this width instead of object arrays.
+        :param fill: Dictionary of field name to the value stored for
+            missing values instead of masking them.
+        :return: OrderedDict of field name to array, or a structured array.
+        '''
+
+        schema = self.doc_type._schema
+        dtypes = [(name, field_dtype(schema.get(name), string_width))
+                  for name in fields]
+        projection = dict((name, 1) for name in fields)
+        projection.setdefault("_id", 0)
+        query = self._clone(_projection=projection, _unloaded=None,
+                            _lazy=False)
+        cursor = query.cursor()
+        return to_arrays(cursor, dtypes, cursor.count(True), structured,
+                         self._batch_size or 1000, fill)
+
+    def afetch(self):
+        ''':return: :class:`concurrent.futures.Future` of a list of all
+        matching documents.'''
+
+        return submit(fetch, self)
+
+    def acount(self, with_limit_and_skip=False):
+        ''':return: :class:`concurrent.futures.Future` of :meth:`count`.'''
+
+        return submit(self.count, with_limit_and_skip)
+
+    def afirst(self):
+        ''':return: :class:`concurrent.futures.Future` of :meth:`first`.'''
+
+        return submit(self.first)
+
+    def abatches(self, size=100):
+        '''Read lists of up to size matching documents in the background.
+        Each call to next_batch of the returned :class:`mongoom.aio.Batches`
+        gives a :class:`concurrent.futures.Future` of the next list, empty
+        at the end. The next batch is read and decoded while the current one
+        is being used.
+
+        Usage, in an asyncio coroutine::
+
+            batches = User.find().abatches(500)
+            users = await asyncio.wrap_future(batches.next_batch())
+            while users:
+                process(users)
+                users = await asyncio.wrap_future(batches.next_batch())
+        '''
+
+        return Batches(self, size)
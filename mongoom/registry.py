@@ -0,0 +1,81 @@
+import warnings
+
+
+TYPES = {}
+COLLECTIONS = {}
+
+
+def type_name(clsname, bases, attrs):
+    '''The _type value stored for a new class. Defaults to the class name.
+    An _alias class attribute replaces the name, a _namespace attribute,
+    inherited by subclasses, prefixes it: "namespace.ClassName".'''
+
+    if attrs.get("_alias"):
+        return attrs["_alias"]
+    namespace = attrs.get("_namespace")
+    if namespace is None:
+        for base in bases:
+            namespace = getattr(base, "_namespace", None)
+            if namespace:
+                break
+    if namespace:
+        return namespace + "." + clsname
+    return clsname
+
+
+def same_class(a, b):
+    '''True if b is a or a redefinition of a, as when a module reloads.'''
+
+    return a is b or (a.__module__, a.__name__) == (b.__module__, b.__name__)
+
+
+def register(cls, collection=None):
+    '''Register cls under its _type name, and :class:`Document` classes
+    under their collection name. Called by :class:`MetaDocument` and
+    :class:`MetaEmbedded` for every new class. Registering an unrelated
+    class under a taken name warns and replaces the previous class, give
+    one of them an _alias or _namespace.
+
+    :param collection: Collection name of a :class:`Document` class.
+    '''
+
+    name = cls._type.default
+    existing = TYPES.get(name)
+    if existing is not None and not same_class(existing, cls):
+        warnings.warn(
+            "_type {!r} of {} replaces {}, set _alias or _namespace.".format(
+                name, cls, existing), RuntimeWarning)
+    TYPES[name] = cls
+
+    if collection is None:
+        return
+    classes = COLLECTIONS.setdefault(collection, [])
+    for i, existing in enumerate(classes):
+        if same_class(existing, cls):
+            classes[i] = cls
+            return
+    classes.append(cls)
+
+
+def get_type(name):
+    ''':return: The class registered under the _type name or None.'''
+
+    return TYPES.get(name)
+
+
+def collection_types(name):
+    ''':return: List of :class:`Document` classes stored in collection,
+    base classes first.'''
+
+    return COLLECTIONS.get(name, [])
+
+
+def ref_type(dbref):
+    ''':return: The :class:`Document` class a :class:`bson.dbref.DBRef`
+    points to or None. References made before DBRefs named collections
+    hold the _type name instead, both are resolved.'''
+
+    classes = COLLECTIONS.get(dbref.collection)
+    if classes:
+        return classes[0]
+    return TYPES.get(dbref.collection)
@@ -0,0 +1,54 @@
+from collections import OrderedDict
+from .utils import is_field
+
+
+class Schema(object):
+    '''A document class' fields compiled into lookup tables. Built once by
+    :class:`MetaDocument` and :class:`MetaEmbedded` when a class is created
+    so instantiation and validation never have to walk the class' mro.
+
+    :attr fields: OrderedDict of field name to :class:`BaseField`, base
+        class fields first, in declaration order.
+    :attr names: Tuple of field names in the same order as fields.
+    :attr required: Tuple of required field names.
+    :attr callable_defaults: Tuple of (name, callable) pairs.
+    :attr copy_defaults: Tuple of (name, value) pairs, values are copied to
+        each new instance.
+
+    A Schema is shared by every instance of a class and must not be
+    modified.
+    '''
+
+    __slots__ = ("fields", "names", "required", "callable_defaults",
+                 "copy_defaults")
+
+    def __init__(self, cls):
+        fields = OrderedDict()
+        for obj in reversed(cls.__mro__):
+            declared = [(k, v) for k, v in obj.__dict__.iteritems()
+                        if is_field(v)]
+            declared.sort(key=lambda item: item[1].order)
+            for name, field in declared:
+                fields[name] = field
+
+        self.fields = fields
+        self.names = tuple(fields)
+        self.required = tuple(
+            name for name, field in fields.iteritems() if field.required)
+        self.callable_defaults = tuple(
+            (name, field.default) for name, field in fields.iteritems()
+            if field.default is not None and callable(field.default))
+        self.copy_defaults = tuple(
+            (name, field.default) for name, field in fields.iteritems()
+            if field.default is not None and not callable(field.default))
+
+    def __repr__(self):
+        return "<Schema({})>".format(", ".join(self.names))
+
+    def __contains__(self, name):
+        return name in self.fields
+
+    def get(self, name):
+        ''':return: :class:`BaseField` named name or None.'''
+
+        return self.fields.get(name)
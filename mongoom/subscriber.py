@@ -1,7 +1,149 @@
+import logging
+import struct
 import sys
-from time import sleep
-from threading import Thread
-from .connection import get_collection
+from calendar import timegm
+from Queue import Queue, Empty, Full
+from tempfile import TemporaryFile
+from threading import Event as ThreadEvent, Lock, Thread
+from time import time
+from bson import BSON, ObjectId
+from .connection import get_database
+from .monitor import operation
+from .registry import get_type
+from .utils import is_document
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+# RUSAGE_THREAD is only exposed by Python 3, its value on linux is 1
+RUSAGE_THREAD = getattr(
+    resource, "RUSAGE_THREAD", 1 if sys.platform.startswith("linux") else None)
+
+
+def cpu_time():
+    ''':return: CPU seconds used by the calling thread, or by the whole
+    process where per thread usage is not available.'''
+
+    if RUSAGE_THREAD is not None:
+        usage = resource.getrusage(RUSAGE_THREAD)
+        return usage.ru_utime + usage.ru_stime
+    if resource is not None:
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        return usage.ru_utime + usage.ru_stime
+    return 0.0
+
+
+log = logging.getLogger(__name__)
+OVERFLOW = ("block", "drop-oldest", "spill")
+POLL = 0.1
+
+
+class Partition(object):
+    '''Bounded FIFO of raw documents consumed by a single worker thread.
+
+    :param size: Maximum number of queued documents.
+    :param overflow: What to do with a document when the queue is full:
+        "block" waits for the worker, "drop-oldest" discards the oldest
+        queued document and "spill" appends the document to a temporary
+        file. Once a partition spills, later documents follow it into the
+        file until the worker drained it, so order is preserved.
+    :param spill_dir: Directory of the spill file.
+    '''
+
+    def __init__(self, size, overflow="block", spill_dir=None):
+        if overflow not in OVERFLOW:
+            raise ValueError("overflow must be one of " + ", ".join(OVERFLOW))
+        self.queue = Queue(size)
+        self.overflow = overflow
+        self.spill_dir = spill_dir
+        self.lock = Lock()
+        self.spill = None
+        self.offset = 0
+        self.pending = 0
+        self.dropped = 0
+        self.spilled = 0
+
+    def __len__(self):
+        return self.queue.qsize() + self.pending
+
+    def put(self, doc, stopped=None):
+        '''Queue a document applying the overflow policy.
+
+        :param stopped: :class:`threading.Event`, "block" gives up waiting
+            and drops the document once it is set.
+        '''
+
+        if self.overflow == "block":
+            while True:
+                try:
+                    self.queue.put(doc, timeout=POLL)
+                    return
+                except Full:
+                    if stopped is not None and stopped.is_set():
+                        self.dropped += 1
+                        return
+        if self.overflow == "drop-oldest":
+            while True:
+                try:
+                    self.queue.put_nowait(doc)
+                    return
+                except Full:
+                    try:
+                        self.queue.get_nowait()
+                        self.dropped += 1
+                    except Empty:
+                        pass
+        with self.lock:
+            if not self.pending:
+                try:
+                    self.queue.put_nowait(doc)
+                    return
+                except Full:
+                    pass
+            if self.spill is None:
+                self.spill = TemporaryFile(dir=self.spill_dir)
+            self.spill.seek(0, 2)
+            self.spill.write(BSON.encode(doc))
+            self.pending += 1
+            self.spilled += 1
+
+    def get(self, timeout=None):
+        '''Next document, waits up to timeout seconds while the partition
+        is empty, raising :class:`Queue.Empty` after that.'''
+
+        try:
+            return self.queue.get_nowait()
+        except Empty:
+            pass
+        with self.lock:
+            if self.pending:
+                return self._unspill()
+        return self.queue.get(timeout=timeout)
+
+    def drain(self):
+        '''Yields spilled documents left over after a stop.'''
+
+        while True:
+            with self.lock:
+                if not self.pending:
+                    return
+                doc = self._unspill()
+            yield doc
+
+    def _unspill(self):
+        self.spill.seek(self.offset)
+        data = self.spill.read(4)
+        size = struct.unpack("<i", data)[0]
+        doc = BSON(data + self.spill.read(size - 4)).decode()
+        self.offset += size
+        self.pending -= 1
+        if not self.pending:
+            self.spill.seek(0)
+            self.spill.truncate()
+            self.offset = 0
+        return doc
 
 
 class Subscriber(Thread):
@@ -9,7 +151,39 @@ class Subscriber(Thread):
     Collection must be initialized with capped=True prior to invoking
     a subscriber thread.
 
-    :param collection: Database collection to be subscribed to.
+    The cursor waits on the server for new documents. While no documents
+    arrive the subscriber backs off, sleeping up to max_idle seconds
+    between polls. When the cursor dies, on an empty collection or after
+    the capped collection rolled over, a new cursor reads the collection
+    again in natural order, which is insertion order, and skips documents
+    up to the last one received, so no documents are handled twice. _ids
+    made by other clients are not ordered, so they are not used to resume.
+    If the last received document rolled out of the collection, all
+    documents of the new cursor are handled.
+
+    With workers set, documents are decoded and handled by a pool of worker
+    threads instead of the tailing thread, so a slow handler does not hold
+    up the cursor. Each worker owns a bounded :class:`Partition`; documents
+    are partitioned by the id of their ref, so documents referring to the
+    same :class:`Document` are handled in order. Exceptions raised while
+    decoding or handling a document are logged and counted, the document
+    is skipped. Documents still queued when the subscriber stops are
+    handled before the workers exit, a tail thread waiting on a full
+    "block" partition drops its document.
+
+    :param collection: Database collection name or :class:`Document`
+        class to be subscribed to.
+    :param max_await: Seconds the server waits for new documents. Only
+        drivers with Cursor.max_await_time_ms, pymongo 3.2 and later,
+        pass it on. With pymongo 2.x it has no effect and the server
+        waits its default of about a second.
+    :param max_idle: Longest sleep between polls of an idle collection.
+    :param workers: Number of worker threads, 0 handles documents on the
+        tailing thread.
+    :param queue_size: Maximum number of documents queued per worker.
+    :param overflow: "block", "drop-oldest" or "spill", see
+        :class:`Partition`.
+    :param spill_dir: Directory of spill files.
     :param *args: standard thread arguments.
     :param **kwargs: standard thread keyword arguments.
 
@@ -17,30 +191,228 @@ class Subscriber(Thread):
 
         mySubscriber = Subscriber("Event")
         mySubscriber.start()
+        ...
+        mySubscriber.stop()
+        print mySubscriber.stats()
     '''
 
+    min_idle = 0.01
+
     def __init__(self, collection, *args, **kwargs):
-        self.collection = get_collection(name=collection)
+        self.max_await = kwargs.pop("max_await", 1.0)
+        self.max_idle = kwargs.pop("max_idle", 1.0)
+        workers = kwargs.pop("workers", 0)
+        queue_size = kwargs.pop("queue_size", 1000)
+        overflow = kwargs.pop("overflow", "block")
+        spill_dir = kwargs.pop("spill_dir", None)
+        self.partitions = [Partition(queue_size, overflow, spill_dir)
+                           for i in xrange(workers)]
+        self.workers = []
+        if is_document(collection):
+            self.doc_type = collection
+            self.collection = collection.get_collection()
+        else:
+            self.doc_type = None
+            self.collection = get_database()[collection]
+        self.last_id = None
+        self.received = 0
+        self.idle_polls = 0
+        self.resumes = 0
+        self.busy_cpu = 0.0
+        self.idle_cpu = 0.0
+        self.started = None
+        self.handled = 0
+        self.errors = 0
+        self.lag = 0.0
+        self.latency = {}
+        self._metrics = Lock()
+        self._stopped = ThreadEvent()
         super(Subscriber, self).__init__(*args, **kwargs)
 
+    def cursor(self):
+        ''':return: Tailable cursor reading the collection in natural
+        order.'''
+
+        cursor = self.collection.find({}, tailable=True, await_data=True)
+        if hasattr(cursor, "max_await_time_ms"):
+            cursor = cursor.max_await_time_ms(int(self.max_await * 1000))
+        return cursor
+
     def run(self):
         '''Start watching a database collection.'''
-        cursor = self.collection.find(tailable=True, await_data=True)
-        while cursor.alive:
+
+        self.started = time()
+        for partition in self.partitions:
+            worker = Thread(target=self.work, args=(partition,))
+            worker.daemon = self.daemon
+            worker.start()
+            self.workers.append(worker)
+        idle = 0
+        cpu = cpu_time()
+        while not self._stopped.is_set():
+            cursor = self.cursor()
+            # Documents read while looking for the last received one
+            seen = [] if self.last_id is not None else None
+            while cursor.alive and not self._stopped.is_set():
+                try:
+                    doc = cursor.next()
+                except StopIteration:
+                    if seen:
+                        # Last received document rolled out, all are new
+                        docs, seen = seen, None
+                    else:
+                        seen = None
+                        self.idle_polls += 1
+                        idle = min(idle * 2 or self.min_idle, self.max_idle)
+                        self._stopped.wait(idle)
+                        continue
+                else:
+                    if seen is not None:
+                        if doc["_id"] == self.last_id:
+                            seen = None
+                        else:
+                            seen.append(doc)
+                        continue
+                    docs = [doc]
+                idle = 0
+                now = cpu_time()
+                self.idle_cpu += now - cpu
+                for doc in docs:
+                    self.last_id = doc["_id"]
+                    self.received += 1
+                    self.put(doc)
+                cpu = cpu_time()
+                self.busy_cpu += cpu - now
+            if not self._stopped.is_set():
+                # Cursor died, back off and resume after last_id
+                self.resumes += 1
+                idle = min(idle * 2 or self.min_idle, self.max_idle)
+                self._stopped.wait(idle)
+        self.idle_cpu += cpu_time() - cpu
+        for worker in self.workers:
+            worker.join()
+
+    def put(self, doc):
+        '''Hand a document to its partition, or dispatch it right away
+        without workers.'''
+
+        if not self.partitions:
+            self.dispatch(doc)
+            return
+        ref = doc.get("ref")
+        key = getattr(ref, "id", ref)
+        if key is None:
+            key = doc["_id"]
+        self.partitions[hash(key) % len(self.partitions)].put(
+            doc, self._stopped)
+
+    def work(self, partition):
+        '''Worker loop, dispatches documents of a partition until stopped
+        and the partition is empty.'''
+
+        while True:
             try:
-                doc = cursor.next()
+                doc = partition.get(POLL)
+            except Empty:
+                if self._stopped.is_set():
+                    break
+                continue
+            self.dispatch(doc)
+        for doc in partition.drain():
+            self.dispatch(doc)
+
+    def dispatch(self, doc):
+        '''Decode and handle a document, recording latency and lag.
+        Exceptions are logged and counted as errors.'''
+
+        start = time()
+        try:
+            with operation("dispatch", doc.get("_type")) as op:
                 self.decode(doc)
-            except StopIteration:
-                sleep(0)
+                op.add(doc)
+        except Exception:
+            log.exception("Failed to handle %s %s", doc.get("_type"),
+                          doc.get("_id"))
+            with self._metrics:
+                self.errors += 1
+            return
+        end = time()
+        _id = doc.get("_id")
+        with self._metrics:
+            self.handled += 1
+            if isinstance(_id, ObjectId):
+                created = timegm(_id.generation_time.utctimetuple())
+                self.lag = max(end - created, 0.0)
+            latency = self.latency.setdefault(
+                doc.get("_type"), {"count": 0, "total": 0.0, "max": 0.0})
+            latency["count"] += 1
+            latency["total"] += end - start
+            latency["max"] = max(latency["max"], end - start)
+
+    def stop(self, timeout=None):
+        '''Stop watching and wait up to timeout seconds for the thread and
+        its workers to finish queued documents.'''
+
+        self._stopped.set()
+        if self.is_alive():
+            self.join(timeout)
+
+    def stats(self):
+        '''Returns a dictionary of counters:
+
+            * received: documents read from the cursor
+            * handled: documents decoded and handled
+            * errors: documents whose decoding or handling raised
+            * idle_polls: polls that returned no documents
+            * resumes: cursors re-created after dying
+            * busy_cpu: CPU seconds spent dispatching documents, queueing
+              only when using workers
+            * idle_cpu: CPU seconds spent in the tail loop itself
+            * elapsed: seconds since the subscriber started
+            * depth: documents waiting in partitions
+            * dropped: documents discarded by "drop-oldest", or by "block"
+              while stopping
+            * spilled: documents written to spill files
+            * lag: seconds between the creation of the last handled
+              document and its handling
+            * latency: count, total and max seconds of handling per _type
+        '''
+
+        with self._metrics:
+            latency = dict((k, dict(v)) for k, v in self.latency.items())
+            handled, errors, lag = self.handled, self.errors, self.lag
+        return {
+            "handled": handled,
+            "errors": errors,
+            "depth": sum(len(p) for p in self.partitions),
+            "dropped": sum(p.dropped for p in self.partitions),
+            "spilled": sum(p.spilled for p in self.partitions),
+            "lag": lag,
+            "latency": latency,
+            "received": self.received,
+            "idle_polls": self.idle_polls,
+            "resumes": self.resumes,
+            "busy_cpu": self.busy_cpu,
+            "idle_cpu": self.idle_cpu,
+            "elapsed": time() - self.started if self.started else 0.0,
+        }
 
     def decode(self, doc):
         '''Decode event document on receiving a doc from tailable cursor.
-        Requires all :class:`Document` subclasses to be
-        imported into the "__main__" module.
+        The :class:`Document` subclass named by the doc's _type must have
+        been imported. Documents of unknown types are decoded as the
+        subscribed :class:`Document` class, or logged and skipped when
+        subscribed to a collection name.
         '''
 
-        doc_type = getattr(sys.modules["__main__"], doc["_type"])
-        document = doc_type(**doc)
+        doc_type = get_type(doc.get("_type"))
+        if not is_document(doc_type):
+            doc_type = self.doc_type
+        if doc_type is None:
+            log.warning("Skipping %s of unknown _type %r", doc.get("_id"),
+                        doc.get("_type"))
+            return
+        document = doc_type.from_son(doc)
         self.handle(document)
 
     def handle(self, document):
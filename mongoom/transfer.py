@@ -0,0 +1,258 @@
+import gzip
+import json
+import os
+import struct
+import sys
+import zlib
+from time import time
+from bson import BSON
+from bson.errors import InvalidBSON
+from bson.json_util import dumps, object_hook
+from bson.son import SON
+from pymongo import ASCENDING, DESCENDING
+from .lazy import raw_collection
+from .registry import collection_types
+try:
+    from bson.codec_options import CodecOptions
+except ImportError:
+    CodecOptions = None
+
+
+FORMATS = (".bson", ".jsonl")
+
+
+def file_format(path):
+    ''':return: ".bson" or ".jsonl" for a path, which may end with ".gz".'''
+
+    name = path[:-3] if path.endswith(".gz") else path
+    for fmt in FORMATS:
+        if name.endswith(fmt):
+            return fmt
+    raise ValueError(
+        "Unknown format of {}, use .bson or .jsonl, "
+        "optionally followed by .gz".format(path))
+
+
+def open_file(path, mode):
+    if path.endswith(".gz"):
+        return gzip.open(path, mode)
+    return open(path, mode)
+
+
+def decode(raw):
+    ''':return: :class:`bson.son.SON` of a BSON document, keeping the
+    order of keys in subdocuments too.'''
+
+    if CodecOptions is None:
+        return BSON(raw).decode(as_class=SON)
+    return BSON(raw).decode(CodecOptions(document_class=SON))
+
+
+def loads(line):
+    ''':return: :class:`bson.son.SON` of an extended JSON document,
+    keeping the order of keys.'''
+
+    return json.loads(line, object_pairs_hook=lambda pairs: object_hook(
+        SON(pairs)))
+
+
+def iter_file(f, fmt):
+    '''Yields documents from an open export file, one at a time, as
+    :class:`bson.son.SON`. Raises :class:`bson.errors.InvalidBSON` or
+    ValueError if the file ends with an incomplete document.'''
+
+    if fmt == ".bson":
+        while True:
+            head = f.read(4)
+            if not head:
+                return
+            if len(head) < 4:
+                raise InvalidBSON("File ends with an incomplete document.")
+            size = struct.unpack("<i", head)[0]
+            data = head + f.read(size - 4)
+            if len(data) < size:
+                raise InvalidBSON("File ends with an incomplete document.")
+            yield decode(data)
+    else:
+        for line in iter(f.readline, ""):
+            if not line.endswith("\n"):
+                raise ValueError("File ends with an incomplete document.")
+            if line.strip():
+                yield loads(line)
+
+
+def read_file(path):
+    '''Yields the documents of a .bson or .jsonl export file.'''
+
+    with open_file(path, "rb") as f:
+        for doc in iter_file(f, file_format(path)):
+            yield doc
+
+
+def resume_file(path):
+    '''Find the last _id of an interrupted export. An incomplete document
+    at the end of an uncompressed file is cut off. Compressed files can
+    not be cut, resuming an incomplete one raises a ValueError.
+
+    :return: Last _id or None.
+    '''
+
+    last, offset, complete = None, 0, True
+    with open_file(path, "rb") as f:
+        try:
+            for doc in iter_file(f, file_format(path)):
+                last = doc["_id"]
+                offset = f.tell()
+        except (InvalidBSON, ValueError, IOError, EOFError, zlib.error):
+            if path.endswith(".gz"):
+                raise ValueError(
+                    "Can not resume {}, the compressed export is "
+                    "incomplete. Export it again.".format(path))
+            complete = False
+    if not complete:
+        with open(path, "r+b") as f:
+            f.truncate(offset)
+    return last
+
+
+class Progress(object):
+    '''Counts transferred documents, calling callback(count, seconds) at
+    most every interval seconds and once when done.'''
+
+    def __init__(self, callback=None, interval=1.0):
+        self.callback = callback
+        self.interval = interval
+        self.count = 0
+        self.started = time()
+        self.reported = self.started
+
+    def add(self, num=1):
+        self.count += num
+        if self.callback is not None:
+            now = time()
+            if now - self.reported >= self.interval:
+                self.reported = now
+                self.callback(self.count, now - self.started)
+
+    def done(self):
+        if self.callback is not None:
+            self.callback(self.count, time() - self.started)
+        return self.count
+
+
+def report(count, seconds, stream=sys.stderr):
+    '''Progress callback writing count and throughput to stream.'''
+
+    rate = count / seconds if seconds else 0
+    stream.write("\r{} documents, {:.0f} documents/s".format(count, rate))
+    stream.flush()
+
+
+def export_collection(doc_type, path, spec=None, after=None, resume=False,
+                      batch_size=1000, progress=None):
+    '''Stream the collection of a :class:`Document` class to a file in
+    constant memory. Documents are written in _id order, as the raw BSON
+    read from the server for .bson files or one extended JSON document per
+    line for .jsonl files, keeping the order of keys. Paths ending with .gz
+    are gzip compressed.
+
+    :param doc_type: :class:`Document` class whose collection is exported.
+    :param path: File to write.
+    :param spec: Query selecting the documents to export.
+    :param after: Only export documents with a greater _id.
+    :param resume: Append to an existing file, continuing after its last
+        document. Incomplete compressed files can not be resumed.
+    :param batch_size: Number of documents the server returns per batch.
+    :param progress: Callable receiving (count, seconds) while exporting.
+    :return: Number of documents exported.
+
+    Usage::
+
+        export_collection(User, "users.bson.gz", progress=report)
+    '''
+
+    fmt = file_format(path)
+    mode = "wb"
+    if resume and os.path.exists(path):
+        mode = "ab"
+        last = resume_file(path)
+        if last is not None:
+            after = last
+    spec = dict(spec or {})
+    if after is not None:
+        if "_id" in spec:
+            spec = {"$and": [spec, {"_id": {"$gt": after}}]}
+        else:
+            spec["_id"] = {"$gt": after}
+
+    col = raw_collection(doc_type.get_collection())
+    cursor = col.find(spec).sort("_id", ASCENDING).batch_size(batch_size)
+    tracker = Progress(progress)
+    with open_file(path, mode) as f:
+        for doc in cursor:
+            if fmt == ".bson":
+                f.write(doc.raw)
+            else:
+                f.write(dumps(decode(doc.raw)) + "\n")
+            tracker.add()
+    return tracker.done()
+
+
+def import_collection(doc_type, path, upsert=False, after=None,
+                      resume=False, batch_size=1000, progress=None):
+    '''Stream an export file into the collection of a :class:`Document`
+    class using unordered bulk writes of batch_size documents.
+
+    :param doc_type: :class:`Document` class whose collection is written.
+    :param path: .bson or .jsonl file, optionally gzip compressed.
+    :param upsert: Replace documents with the same _id instead of
+        inserting, duplicate _ids fail otherwise. Cached objects of the
+        imported _ids are dropped from the identity maps.
+    :param after: Skip documents with an _id less than or equal to after.
+    :param resume: Skip documents up to the greatest _id in the collection,
+        continuing an interrupted import of a file in _id order.
+    :param batch_size: Number of documents written per bulk operation.
+    :param progress: Callable receiving (count, seconds) while importing.
+    :return: Number of documents imported.
+    '''
+
+    col = doc_type.get_collection()
+    if resume:
+        for doc in col.find({}, {"_id": 1}).sort("_id", DESCENDING).limit(1):
+            after = doc["_id"]
+
+    tracker = Progress(progress)
+    batch = []
+    for doc in read_file(path):
+        if after is not None and doc["_id"] <= after:
+            continue
+        batch.append(doc)
+        if len(batch) >= batch_size:
+            write_batch(col, batch, upsert)
+            uncache(doc_type, [doc["_id"] for doc in batch])
+            tracker.add(len(batch))
+            batch = []
+    if batch:
+        write_batch(col, batch, upsert)
+        uncache(doc_type, [doc["_id"] for doc in batch])
+        tracker.add(len(batch))
+    return tracker.done()
+
+
+def uncache(doc_type, ids):
+    '''Remove ids from the identity maps of the classes stored in the
+    collection of doc_type, so imported documents are read again.'''
+
+    for cls in collection_types(doc_type.collection()["name"]) or [doc_type]:
+        for _id in ids:
+            cls.__cache__.pop(cls.cache_key(_id))
+
+
+def write_batch(col, batch, upsert):
+    bulk = col.initialize_unordered_bulk_op()
+    for doc in batch:
+        if upsert:
+            bulk.find({"_id": doc["_id"]}).upsert().replace_one(doc)
+        else:
+            bulk.insert(doc)
+    bulk.execute()
@@ -15,9 +15,8 @@ def rget_subclasses(cls):
 
 def is_field(value):
     from .fields import BaseField
-    all_fields = tuple([BaseField] + rget_subclasses(BaseField))
-    if isinstance(value, all_fields):
-            return True
+    if isinstance(value, BaseField):
+        return True
 
 
 def is_document(value):
@@ -1,10 +1,14 @@
 from nose.tools import ok_, eq_, raises
 from mongoom import *
 from mongoom.fields import ValidationError
-from mongoom.connection import get_connection, get_database
+from mongoom.documents import dereference_many
+from mongoom.connection import (get_connection, get_database, drop_database,
+                                get_collection, disconnect, ENSURED)
 from bson.objectid import ObjectId
 from bson import DBRef
+from pymongo.errors import OperationFailure
 from datetime import datetime
+from time import sleep
 
 C = connect("test_db", "localhost", 27017)
 
@@ -52,9 +56,23 @@ class CheckList(Document):
     items = ListField(CheckListItem)
 
 
+class Asset(Document):
+    _connection = "shared"
+    size = Field(int)
+
+
+def asset_size(asset):
+    return asset.size
+
+
+def asset_size_pid(asset):
+    import os
+    return asset.size, os.getpid()
+
+
 def test_connect():
     '''Connection'''
-    C.drop_database("test_db")
+    drop_database("test_db")
 
     eq_(get_database(), c.test_db)
 
@@ -65,7 +83,7 @@ def test_connect():
 
 def test_save():
     '''Save Document'''
-    C.drop_database("test_db")
+    drop_database("test_db")
 
     frank = User(
         name="Frank",
@@ -85,7 +103,7 @@ def test_save():
 
 def test_find_one():
     '''Find One'''
-    C.drop_database("test_db")
+    drop_database("test_db")
 
     c.test_db.User.insert({"name": "Frank", "last_name": "Footer"})
 
@@ -96,7 +114,7 @@ def test_find_one():
 
 def test_find():
     '''Find'''
-    C.drop_database("test_db")
+    drop_database("test_db")
 
     frank = User(
         name="Frank",
@@ -120,7 +138,7 @@ def test_find():
 @raises(ValidationError)
 def test_missing_required():
     '''Missing Required Field'''
-    C.drop_database("test_db")
+    drop_database("test_db")
 
     #Try to save while missing a required field (last_name)
     User(name="Frank").save()
@@ -128,7 +146,7 @@ def test_missing_required():
 
 def test_RefField():
     '''RefField'''
-    C.drop_database("test_db")
+    drop_database("test_db")
 
     frank = User(
         name="Frank",
@@ -144,7 +162,7 @@ def test_RefField():
 
 def test_ListField():
     '''ListField'''
-    C.drop_database("test_db")
+    drop_database("test_db")
 
     frank = User(
         name="Frank",
@@ -166,7 +184,7 @@ def test_ListField():
 
 def test_deref():
     '''Test dereferencing of ListField descriptor'''
-    C.drop_database("test_db")
+    drop_database("test_db")
 
     frank = User(
         name="Frank",
@@ -203,7 +221,7 @@ def test_deref():
 
 def test_ref():
     '''Test Reference ability of Field and ListField'''
-    C.drop_database("test_db")
+    drop_database("test_db")
 
     user_a = User(name="User", last_name="A").save()
     comp_a = Container(name="Component A", user=user_a).save()
@@ -218,7 +236,7 @@ def test_ref():
 def test_embed():
     '''Test Embedded Document'''
 
-    C.drop_database("test_db")
+    drop_database("test_db")
 
     user_a = User(name="User", last_name="A").save()
     clist = CheckList(title="New Checklist", user=user_a).save()
@@ -242,3 +260,885 @@ def test_index():
     index_name = "_".join(
         [str(item) for key in index_kwargs["key_or_list"] for item in key])
     ok_(index_name in db.User.index_information())
+
+
+def test_schema():
+    '''Schema compiled at class creation'''
+
+    eq_(User._schema.names,
+        ("_type", "_id", "name", "last_name", "created"))
+    eq_(User._schema.required, ("name", "last_name"))
+    ok_(User._schema.get("created") is User.__dict__["created"])
+    eq_(dict(Container._schema.copy_defaults), {"_type": "Container"})
+    ok_(all(isinstance(v, BaseField) for v in Container().fields.values()))
+
+
+def test_ensured_collection():
+    '''Collections and indexes are only ensured once'''
+    drop_database("test_db")
+
+    col = get_collection(User.index(), User.collection())
+    ok_(("default", "test_db", "User") in ENSURED)
+    ok_(get_collection(User.index(), User.collection()) is col)
+
+    User.drop()
+    ok_(("default", "test_db", "User") not in ENSURED)
+    User(name="Frank", last_name="Footer").save()
+    ok_("name_1_last_name_1" in get_database().User.index_information())
+
+
+def test_save_many():
+    '''Bulk insert and upsert'''
+    drop_database("test_db")
+
+    frank = User(name="Frank", last_name="Footer").save()
+    frank.last_name = "Footers"
+    users = [User(name="User", last_name=str(i)) for i in xrange(10)]
+    missing = User(name="Missing")
+
+    errors = User.save_many([frank, missing] + users, batch_size=4)
+    eq_(len(errors), 1)
+    ok_(errors[0][0] is missing)
+    ok_(isinstance(errors[0][1], ValidationError))
+    ok_(all(isinstance(user._id, ObjectId) for user in users))
+    ok_(User.get_cache(users[0]._id) is users[0])
+    eq_(len(list(User.find(name="User"))), 10)
+    eq_(User.find_one(name="Frank").last_name, "Footers")
+
+    duplicate = User(name="User", last_name="0")
+    errors = User.save_many([duplicate])
+    ok_(errors[0][0] is duplicate)
+    ok_("_id" not in duplicate.data)
+
+    # Ordered writes report the documents after a failure as not written
+    docs = [User(name="Ordered", last_name=name) for name in "abcd"]
+    del docs[1].last_name
+    errors = User.save_many(docs, ordered=True)
+    eq_([doc for doc, e in errors], docs[1:])
+    ok_(isinstance(errors[0][1], ValidationError))
+    ok_(all(isinstance(e, OperationFailure) for doc, e in errors[1:]))
+    eq_([u.last_name for u in User.find(name="Ordered")], ["a"])
+
+
+def test_dirty():
+    '''Save sends $set and $unset of dirty fields only'''
+    drop_database("test_db")
+
+    frank = User(name="Frank", last_name="Footer").save()
+    eq_(frank.dirty, frozenset())
+    frank.last_name = "Footers"
+    eq_(frank.changes(), {"$set": {"last_name": "Footers"}})
+    frank.save()
+    eq_(frank.dirty, frozenset())
+
+    clist = CheckList(title="Checklist", user=frank).save()
+    clist.items += CheckListItem(text="Item A")
+    eq_(clist.dirty, frozenset(["items"]))
+    clist.save()
+    clist.items[0].checked = True
+    eq_(clist.dirty, frozenset(["items"]))
+    del clist.title
+    eq_(clist.changes()["$unset"], {"title": ""})
+    clist.save()
+
+    doc = get_database().CheckList.find_one({"_id": clist._id})
+    ok_("title" not in doc)
+    ok_(doc["items"][0]["checked"])
+
+    # Defaults of loaded documents are not saved unless changed
+    _id = get_database().User.insert({"name": "Old", "last_name": "Timer"})
+    old = User.find_one(_id=_id)
+    ok_(isinstance(old.created, datetime))
+    eq_(old.dirty, frozenset())
+    old.name = "Older"
+    eq_(old.changes(), {"$set": {"name": "Older"}})
+    old.save()
+    ok_("created" not in get_database().User.find_one({"_id": _id}))
+
+
+def test_identity_map():
+    '''Identity map entries die with their documents'''
+    import gc
+    from mongoom.identity import IdentityMap
+
+    class Cached(Document):
+        _cache_size = 2
+        name = Field(basestring)
+
+    ok_(isinstance(Cached.__cache__, IdentityMap))
+    eq_(Cached.__cache__.size, 2)
+
+    _ids = [ObjectId() for i in xrange(4)]
+    docs = [Cached(_id=_id, name="doc") for _id in _ids]
+    for _id in _ids:
+        ok_(Cached.get_cache(_id) is not None)
+    del docs
+    gc.collect()
+
+    eq_(len(Cached.__cache__), 2)
+    ok_(Cached.get_cache(_ids[0]) is None)
+    ok_(Cached.get_cache(_ids[-1]) is not None)
+    stats = Cached.__cache__.stats()
+    eq_(stats["strong"], 2)
+    ok_(stats["evictions"] >= 2)
+    eq_(stats["misses"], 1)
+
+
+def test_lazy():
+    '''Lazy documents decode fields on first read'''
+    from bson import BSON
+    from mongoom.lazy import LazyData
+    drop_database("test_db")
+
+    data = LazyData(BSON.encode({"name": "Frank", "images": ["a", "b"]}))
+    eq_(data.pending, frozenset(["name", "images"]))
+    eq_(data["name"], "Frank")
+    eq_(data.pending, frozenset(["images"]))
+    ok_("images" in data)
+    del data["images"]
+    ok_("images" not in data)
+    eq_(dict(data.items()), {"name": "Frank"})
+
+    User(name="Frank", last_name="Footer").save()
+    User.__cache__.clear()
+    frank = User.find_one(lazy=True, name="Frank")
+    ok_(isinstance(frank._data, LazyData))
+    ok_("last_name" in frank._data.pending)
+    eq_(frank.last_name, "Footer")
+    ok_("last_name" not in frank._data.pending)
+    frank.last_name = "Footers"
+    frank.save()
+    eq_(get_database().User.find_one()["last_name"], "Footers")
+    ok_(all(isinstance(user, User) for user in User.find(lazy=True)))
+
+    # pymongo 2.x replies are only patched when a lazy query needs it, and
+    # only if pymongo's function looks as expected
+    from mongoom import lazy
+    if lazy.RawBSONDocument is None:
+        from pymongo import helpers
+        eq_(helpers._unpack_response, lazy._unpack_raw_response)
+        saved, original = helpers._unpack_response, lazy._unpack_response
+        helpers._unpack_response = lambda data, *args: None
+        try:
+            lazy.install_raw_replies()
+        except RuntimeError:
+            pass
+        else:
+            raise AssertionError("Patched an unknown _unpack_response")
+        finally:
+            helpers._unpack_response = saved
+            lazy._unpack_response = original
+
+
+def test_prefetch():
+    '''Prefetch references while iterating find'''
+    drop_database("test_db")
+
+    frank = User(name="Frank", last_name="Footer").save()
+    bob = User(name="Bob", last_name="Oob").save()
+    for i in xrange(10):
+        Version(name="v{:03d}".format(i), user=(frank, bob)[i % 2]).save()
+
+    versions = list(Version.find(prefetch=["user"]))
+    ok_(all(version._refs for version in versions))
+    ok_(all(version.user in (frank, bob) for version in versions))
+
+    refs = [version._data["user"] for version in versions]
+    resolved = dereference_many(refs)
+    eq_(set(resolved.values()), set([frank, bob]))
+
+
+@raises(ValueError)
+def test_prefetch_invalid():
+    '''Prefetch only accepts reference fields'''
+
+    list(Version.find(prefetch=["name"]))
+
+
+def test_memoized_decode():
+    '''Decoded references and embedded documents are kept per instance'''
+    drop_database("test_db")
+
+    frank = User(name="Frank", last_name="Footer").save()
+    bob = User(name="Bob", last_name="Oob").save()
+    version = Version(name="master", user=frank)
+
+    ok_(version.user is version.user)
+    eq_(version._decoded["user"], frank)
+    version.user = bob
+    ok_("user" not in version._decoded)
+    ok_(version.user is bob)
+
+    clist = CheckList(title="Checklist", user=frank).save()
+    clist.items += CheckListItem(text="Item A")
+    clist.save()
+    ok_(clist.user is clist.user)
+    clist.data = {"user": bob.ref}
+    ok_(clist.user is bob)
+
+
+def test_list_dereference():
+    '''Iterating a ListField of references resolves them in one query'''
+    import gc
+    drop_database("test_db")
+
+    frank = User(name="Frank", last_name="Footer").save()
+    model = Component(name="Model", user=frank)
+    model.versions += [Version(name="v{:03d}".format(i)).save()
+                       for i in xrange(5)]
+    model.save()
+    _id = model._id
+    del model
+    gc.collect()
+
+    model = Component.find_one(_id=_id)
+    eq_(len(model._refs), 0)
+    names = [version.name for version in model.versions]
+    eq_(names, ["v000", "v001", "v002", "v003", "v004"])
+    eq_(len(model._refs), 5)
+    eq_([v.name for v in model.versions[1:3]], ["v001", "v002"])
+    ok_(model.versions[0] is model._refs[model._data["versions"][0]])
+
+
+def test_queryset():
+    '''Chainable server-side queries'''
+    drop_database("test_db")
+
+    for i in xrange(10):
+        Version(name="v{:03d}".format(i), path=("a", "b")[i % 2]).save()
+
+    query = Version.find(path="a")
+    eq_(query.count(), 5)
+    eq_([v.name for v in query.order_by("-name").limit(2)],
+        ["v008", "v006"])
+    eq_(query.order_by("name").first().name, "v000")
+    eq_([v.name for v in query.order_by("name")[1:3]], ["v002", "v004"])
+    eq_(query.order_by("name")[4].name, "v008")
+    eq_(list(query[2:2]), [])
+    eq_(query[3:1].count(), 0)
+    eq_([v.name for v in query.order_by("name").limit(3)[1:10]],
+        ["v002", "v004"])
+    eq_([v.name for v in query.order_by("name").limit(3)[1:]],
+        ["v002", "v004"])
+    eq_(list(query.limit(3)[3:5]), [])
+    raises(IndexError)(lambda: query.limit(3)[3])()
+    eq_(query.filter(name="v002").count(), 1)
+    eq_(Version.find().skip(8).count(with_limit_and_skip=True), 2)
+    eq_(Version.find().batch_size(2).hint([("_id", 1)]).count(), 10)
+    doc = Version.find(decode=False).only("name").first()
+    ok_("path" not in doc)
+
+
+def test_partial():
+    '''Fields left out by a projection are loaded on demand'''
+    import gc
+    drop_database("test_db")
+
+    frank = User(name="Frank", last_name="Footer").save()
+    # BSON keeps milliseconds, compare with the stored value
+    created = get_database().User.find_one()["created"]
+    del frank
+    gc.collect()
+
+    frank = User.find(only=["name"]).first()
+    eq_(frank.unloaded, frozenset(["last_name", "created"]))
+    ok_("created" not in frank.data)
+    frank.name = "Franky"
+    frank.save()
+    eq_(frank.last_name, "Footer")
+    eq_(frank.unloaded, frozenset(["created"]))
+    doc = get_database().User.find_one()
+    eq_(doc["created"], created)
+    eq_(doc["name"], "Franky")
+
+    del frank
+    gc.collect()
+    frank = User.find_one(exclude=["created"], name="Franky")
+    eq_(frank.unloaded, frozenset(["created"]))
+    frank.load()
+    eq_(frank.created, created)
+
+    # Fields missing from the stored document get their defaults
+    get_database().User.insert({"name": "Old", "last_name": "Timer"})
+    old = User.find(only=["name"], name="Old").first()
+    ok_(isinstance(old.created, datetime))
+    eq_(old.dirty, frozenset())
+
+
+def test_async():
+    '''Futures based asynchronous api'''
+    drop_database("test_db")
+
+    futures = [User(name="User", last_name=str(i)).asave()
+               for i in xrange(10)]
+    users = [future.result() for future in futures]
+    ok_(all(isinstance(user._id, ObjectId) for user in users))
+
+    eq_(len(User.afind(name="User").result()), 10)
+    ok_(User.afind_one(last_name="3").result() is users[3])
+    eq_(User.find().acount().result(), 10)
+    batches = User.find().abatches(4)
+    futures = [batches.next_batch() for i in xrange(5)]
+    eq_([len(future.result()) for future in futures], [4, 4, 2, 0, 0])
+    ok_(User.adereference(users[0].ref).result() is users[0])
+    users[0].aremove().result()
+    eq_(User.find().count(), 9)
+
+
+def test_subscriber():
+    '''Subscriber blocks while idle and resumes after the last document'''
+    drop_database("test_db")
+
+    class Collect(Subscriber):
+
+        def decode(self, doc):
+            received.append(doc["_id"])
+
+    received = []
+    frank = User(name="Frank", last_name="Footer").save()
+    subscriber = Collect(Event, max_await=0.1, max_idle=0.05)
+    subscriber.daemon = True
+    events = [Event(ref=frank).save() for i in xrange(3)]
+    subscriber.start()
+    sleep(0.2)
+    events.append(Event(ref=frank).save())
+    sleep(0.2)
+    # Another client's _id may sort before the last received one
+    early = ObjectId.from_datetime(datetime(2000, 1, 1))
+    get_database().Event.insert({"_id": early, "_type": "Event"})
+    sleep(0.2)
+    subscriber.stop(1)
+
+    ok_(not subscriber.is_alive())
+    eq_(received, [event._id for event in events] + [early])
+    stats = subscriber.stats()
+    eq_(stats["received"], 5)
+    ok_(stats["idle_polls"] + stats["resumes"] > 0)
+    ok_(stats["idle_polls"] + stats["resumes"] < 100)
+
+
+def test_subscriber_workers():
+    '''Subscriber workers keep per ref order and spill on overflow'''
+    drop_database("test_db")
+
+    class Collect(Subscriber):
+
+        def decode(self, doc):
+            sleep(0.01)
+            received.setdefault(doc["ref"].id, []).append(doc["_id"])
+
+    received = {}
+    users = [User(name="User", last_name=str(i)).save() for i in xrange(3)]
+    events = [Event(ref=users[i % 3]).save() for i in xrange(12)]
+    subscriber = Collect(Event, max_await=0.1, max_idle=0.05, workers=2,
+                         queue_size=1, overflow="spill")
+    subscriber.daemon = True
+    subscriber.start()
+    sleep(0.3)
+    subscriber.stop(1)
+
+    for i, user in enumerate(users):
+        eq_(received[user._id], [event._id for event in events[i::3]])
+    stats = subscriber.stats()
+    eq_(stats["handled"], 12)
+    eq_(stats["depth"], 0)
+    ok_(stats["spilled"] > 0)
+    eq_(stats["latency"]["Event"]["count"], 12)
+
+
+def test_subscriber_errors():
+    '''Failing documents are counted and do not stop the workers'''
+    import logging
+    drop_database("test_db")
+
+    class Failing(Subscriber):
+
+        def decode(self, doc):
+            if doc["ref"].id == users[0]._id:
+                raise ValueError("Broken event")
+            sleep(0.01)
+
+    users = [User(name="User", last_name=str(i)).save() for i in xrange(2)]
+    for i in xrange(6):
+        Event(ref=users[i % 2]).save()
+    logging.getLogger("mongoom.subscriber").disabled = True
+    subscriber = Failing(Event, max_await=0.1, max_idle=0.05, workers=1,
+                         queue_size=1)
+    subscriber.daemon = True
+    try:
+        subscriber.start()
+        sleep(0.3)
+        subscriber.stop(1)
+    finally:
+        logging.getLogger("mongoom.subscriber").disabled = False
+
+    ok_(not subscriber.is_alive())
+    stats = subscriber.stats()
+    eq_(stats["errors"], 3)
+    eq_(stats["handled"], 3)
+
+    class Slow(Subscriber):
+
+        def decode(self, doc):
+            sleep(0.2)
+
+    # The tail thread waits on a full partition when stopped
+    subscriber = Slow(Event, max_await=0.1, workers=1, queue_size=1)
+    subscriber.daemon = True
+    subscriber.start()
+    sleep(0.1)
+    subscriber.stop(1)
+    ok_(not subscriber.is_alive())
+    eq_(subscriber.stats()["dropped"], 1)
+
+
+def test_subscriber_unknown_type():
+    '''Unknown _types fall back to the subscribed class or are skipped'''
+    import logging
+    drop_database("test_db")
+
+    class Collect(Subscriber):
+
+        def handle(self, document):
+            handled.append(type(document))
+
+    Event(ref=User(name="Frank", last_name="Footer").save()).save()
+    get_database().Event.insert({"_type": "Unknown"})
+    logging.getLogger("mongoom.subscriber").disabled = True
+    try:
+        for collection, expected in ((Event, [Event, Event]),
+                                     ("Event", [Event])):
+            handled = []
+            subscriber = Collect(collection, max_await=0.1, max_idle=0.05)
+            subscriber.daemon = True
+            subscriber.start()
+            sleep(0.2)
+            subscriber.stop(1)
+            eq_(handled, expected)
+            eq_(subscriber.stats()["errors"], 0)
+    finally:
+        logging.getLogger("mongoom.subscriber").disabled = False
+
+
+def test_partition_drop_oldest():
+    '''Partition drops the oldest document when full'''
+    from mongoom.subscriber import Partition
+
+    partition = Partition(2, "drop-oldest")
+    for i in xrange(4):
+        partition.put({"_id": i})
+    eq_(partition.dropped, 2)
+    eq_([partition.get()["_id"] for i in xrange(2)], [2, 3])
+
+
+def test_publisher():
+    '''Publisher batches fired events and flushes on stop'''
+    drop_database("test_db")
+
+    frank = User(name="Frank", last_name="Footer").save()
+    event = Event.fire(ref=frank)
+    ok_(isinstance(event._id, ObjectId))
+
+    publisher = Publisher(batch_size=5, interval=10)
+    publisher.start()
+    set_publisher(publisher)
+    try:
+        events = [Event.fire(ref=frank) for i in xrange(4)]
+        sleep(0.1)
+        eq_(Event.find().count(), 1)
+        ok_("_id" not in events[-1].data)
+        events.append(Event.fire(ref=frank))
+        sleep(0.1)
+        eq_(Event.find().count(), 6)
+        events.append(Event.fire(ref=frank))
+
+        # Invalid events raise in the firing thread and are not buffered
+        class Rated(Event):
+            stars = Field(int, required=True)
+
+        try:
+            Rated.fire(ref=frank)
+        except ValidationError:
+            pass
+        else:
+            raise AssertionError("Invalid event was buffered")
+    finally:
+        publisher.stop(1)
+        set_publisher(None)
+
+    eq_(Event.find().count(), 7)
+    eq_([e._id for e in Event.find()][1:], [e._id for e in events])
+    eq_(publisher.stats()["written"], 6)
+    eq_(publisher.stats()["published"], 6)
+    eq_(publisher.stats()["failed"], 0)
+    ok_(not publisher.publish(Event(ref=frank)))
+
+
+def test_registry():
+    '''Classes are registered by _type and collection'''
+    from mongoom.registry import get_type, ref_type
+    drop_database("test_db")
+
+    class Updated(Event):
+        _namespace = "test"
+
+    class Renamed(Updated):
+        _alias = "Moved"
+
+    eq_(get_type("test.Updated"), Updated)
+    eq_(get_type("Moved"), Renamed)
+    eq_(get_type("Renamed"), None)
+
+    frank = User(name="Frank", last_name="Footer").save()
+    event = Renamed(ref=frank).save()
+    eq_(event._data["ref"], DBRef("User", frank._id))
+    ok_(ref_type(DBRef("Event", event._id)) is Event)
+    ok_(ref_type(DBRef("Moved", event._id)) is Renamed)
+    eq_(Event.find_one(_id=event._id)._type, "Moved")
+    eq_(Event.decode_type({"_type": "Moved"}), Renamed)
+    eq_(Updated.decode_type({"_type": "Event"}), Updated)
+
+
+def test_from_son():
+    '''from_son adopts stored data without validation'''
+    drop_database("test_db")
+
+    son = {"_id": ObjectId(), "_type": "User", "name": "Frank",
+           "last_name": 5}
+    frank = User.from_son(son)
+    ok_(frank._data is son)
+    eq_(frank.last_name, 5)
+    ok_(User.get_cache(son["_id"]) is frank)
+    ok_("created" in son)
+    eq_(frank.dirty, frozenset())
+
+    frank.name = "Bob"
+    refreshed = User.from_son({"_id": son["_id"], "_type": "User",
+                               "last_name": "Footer"})
+    ok_(refreshed is frank)
+    eq_(frank.name, "Bob")
+    eq_(frank.last_name, "Footer")
+    eq_(frank.dirty, frozenset(["name"]))
+
+
+def test_compact():
+    '''Compact documents keep their values in slots'''
+    from mongoom.compact import CompactData
+    drop_database("test_db")
+
+    class Sample(Document):
+        _compact = True
+        name = Field(basestring, required=True)
+        count = Field(int, default=0)
+
+    sample = Sample(name="a").save()
+    ok_(not hasattr(sample, "__dict__"))
+    ok_(isinstance(sample._data, CompactData))
+    eq_(sample.data, {"_id": sample._id, "_type": "Sample", "name": "a",
+                      "count": 0})
+
+    sample.count += 1
+    sample.save()
+    Sample.__cache__.clear()
+    loaded = Sample.find_one(name="a")
+    ok_(loaded is not sample)
+    eq_(loaded.count, 1)
+    eq_(loaded.dirty, frozenset())
+
+    # Lazy compact documents decode fields into their slots when read
+    Sample.__cache__.clear()
+    lazy = Sample.find_one(lazy=True, name="a")
+    ok_(isinstance(lazy._data, CompactData))
+    eq_(lazy._data._source.pending, frozenset(["_type", "name", "count"]))
+    eq_(lazy.name, "a")
+    eq_(lazy._data._source.pending, frozenset(["_type", "count"]))
+    eq_(lazy.data, loaded.data)
+    ok_(lazy._data._source is None)
+
+
+def test_find_arrays():
+    '''find_arrays reads fields into typed numpy arrays'''
+    try:
+        import numpy
+    except ImportError:
+        from nose.plugins.skip import SkipTest
+        raise SkipTest("numpy is not installed")
+    drop_database("test_db")
+
+    class Measure(Document):
+        size = Field(int)
+        weight = Field(float)
+        created = Field(datetime, default=datetime.utcnow)
+        label = Field(basestring)
+
+    for i in xrange(5):
+        Measure(size=i, weight=i / 2.0, label="m{}".format(i)).save()
+    Measure(label="empty").save()
+
+    columns = Measure.find_arrays(["size", "weight", "created", "label"])
+    eq_(columns.keys(), ["size", "weight", "created", "label"])
+    eq_(columns["size"].dtype, numpy.dtype("i8"))
+    eq_(columns["size"].tolist(), [0, 1, 2, 3, 4, None])
+    eq_(columns["size"].mask.tolist(), [False] * 5 + [True])
+    ok_(numpy.isnan(columns["weight"][5]))
+    eq_(columns["created"].dtype, numpy.dtype("datetime64[ms]"))
+    eq_(columns["label"][0], "m0")
+
+    table = Measure.find(size={"$gte": 3}).arrays(
+        ["size", "label"], structured=True, string_width=8)
+    eq_(table["size"].tolist(), [3, 4])
+    eq_(table.dtype["label"], numpy.dtype("U8"))
+    ok_(not isinstance(table, numpy.ma.MaskedArray))
+
+    columns = Measure.find_arrays(["size"], fill={"size": -1})
+    ok_(not isinstance(columns["size"], numpy.ma.MaskedArray))
+    eq_(columns["size"].tolist(), [0, 1, 2, 3, 4, -1])
+    table = Measure.find_arrays(["size", "weight"], structured=True)
+    eq_(table.mask["size"].tolist(), [False] * 5 + [True])
+    eq_(table.mask["weight"].tolist(), [False] * 6)
+
+
+def test_transfer():
+    '''Export and import collections in constant memory'''
+    import os
+    import shutil
+    import tempfile
+    from mongoom.transfer import (export_collection, import_collection,
+                                  read_file)
+    drop_database("test_db")
+
+    users = [User(name="User", last_name=str(i)).save() for i in xrange(5)]
+    tmp = tempfile.mkdtemp()
+    try:
+        for name in ("users.bson", "users.jsonl.gz"):
+            path = os.path.join(tmp, name)
+            eq_(export_collection(User, path, after=users[1]._id), 3)
+            eq_(export_collection(User, path, resume=True), 0)
+            User.drop()
+            eq_(import_collection(User, path), 3)
+            eq_(import_collection(User, path, resume=True), 0)
+            User.find_one(_id=users[2]._id)
+            eq_(import_collection(User, path, upsert=True), 3)
+            ok_(User.get_cache(users[2]._id) is None)
+            eq_([u["_id"] for u in User.find(decode=False)],
+                [u._id for u in users[2:]])
+
+        path = os.path.join(tmp, "some.jsonl")
+        eq_(export_collection(User, path, after=users[2]._id,
+                              spec={"_id": {"$ne": users[4]._id}}), 1)
+        eq_([doc["_id"] for doc in read_file(path)], [users[3]._id])
+
+        path = os.path.join(tmp, "users.bson")
+        with open(path, "ab") as f:
+            f.write("\x10\x00")  # Interrupted while writing
+        User(name="User", last_name="5").save()
+        eq_(export_collection(User, path, resume=True), 1)
+        eq_(len(list(read_file(path))), 4)
+
+        # Subdocuments keep the order of their keys
+        from bson.son import SON
+        _id = get_database().User.insert(SON([
+            ("name", "Nested"), ("last_name", "Order"),
+            ("nested", SON([("z", 1), ("a", 2), ("m", 3)]))]))
+        for name in ("nested.bson", "nested.jsonl"):
+            path = os.path.join(tmp, name)
+            export_collection(User, path, spec={"name": "Nested"})
+            doc, = read_file(path)
+            eq_(doc["nested"].keys(), ["z", "a", "m"])
+
+        path = os.path.join(tmp, "users.bson.gz")
+        eq_(export_collection(User, path), 5)
+        with open(path, "r+b") as f:
+            f.truncate(os.path.getsize(path) - 10)
+        try:
+            export_collection(User, path, resume=True)
+        except ValueError as e:
+            ok_("compressed" in str(e))
+        else:
+            raise AssertionError("Resumed an incomplete compressed export")
+    finally:
+        shutil.rmtree(tmp)
+
+
+def test_monitor():
+    '''Instrument operations and aggregate them per class'''
+    from mongoom.monitor import StatsCollector, add_listener, remove_listener
+    drop_database("test_db")
+
+    stats = StatsCollector()
+    add_listener(stats, sizes=True)
+    try:
+        user = User(name="Frank", last_name="Footer").save()
+        user.name = "Franky"
+        user.save()
+        Event(ref=user).save()
+        User.__cache__.clear()
+        Event.__cache__.clear()
+        list(User.find(name="Franky"))
+        event = Event.find_one()
+        event.ref
+        user.remove()
+    finally:
+        remove_listener(stats)
+
+    operations = stats.as_dict()["operations"]
+    eq_(operations["save"]["User"]["count"], 2)
+    eq_(operations["find"]["User"]["documents"], 1)
+    ok_(operations["find"]["User"]["bytes"] > 0)
+    eq_(operations["find_one"]["Event"]["count"], 1)
+    eq_(operations["dereference"]["User"]["documents"], 1)
+    eq_(operations["remove"]["User"]["count"], 1)
+    eq_(operations["find"]["User"]["buckets"][-1][1], 1)
+
+    text = stats.prometheus()
+    ok_('mongoom_operation_seconds_count{operation="save",document="User"} 2'
+        in text)
+    ok_('mongoom_identity_map_entries{document="User"}' in text)
+
+    # Only raw documents are measured unless sizes are asked for
+    stats = StatsCollector()
+    add_listener(stats)
+    try:
+        User(name="Frank", last_name="Footer").save()
+        User.__cache__.clear()
+        list(User.find())
+        User.__cache__.clear()
+        list(User.find(lazy=True))
+    finally:
+        remove_listener(stats)
+    operations = stats.as_dict()["operations"]
+    eq_(operations["save"]["User"]["bytes"], 0)
+    eq_(operations["find"]["User"]["documents"], 2)
+    ok_(operations["find"]["User"]["bytes"] > 0)
+
+
+def test_connection_alias():
+    '''Bind Document classes to named connections and databases'''
+    drop_database("test_db")
+
+    class Metric(Document):
+        _connection = "analytics"
+        value = Field(int)
+
+    connect("test_stats", "localhost", 27017, alias="analytics",
+            max_pool_size=4)
+    try:
+        drop_database("test_stats", "analytics")
+        Metric(value=1).save()
+        eq_(get_database("analytics").Metric.count(), 1)
+        eq_(get_database().Metric.count(), 0)
+
+        drop_database("test_stats_2", "analytics")
+        with Metric.bind(database="test_stats_2"):
+            Metric(value=2).save()
+            eq_([m.value for m in Metric.find()], [2])
+        eq_([m.value for m in Metric.find()], [1])
+        eq_(get_database("analytics", "test_stats_2").Metric.count(), 1)
+        ok_("_database" not in Metric.__dict__)
+
+        # Bindings are per thread
+        import threading
+        bound, values = threading.Event(), []
+
+        def read():
+            with Metric.bind(database="test_stats_2"):
+                bound.set()
+                values.append([m.value for m in Metric.find()])
+                release.wait()
+
+        release = threading.Event()
+        thread = threading.Thread(target=read)
+        thread.start()
+        bound.wait()
+        eq_([m.value for m in Metric.find()], [1])
+        release.set()
+        thread.join()
+        eq_(values, [[2]])
+
+        # The same _id in two databases gives two objects
+        metric = Metric.find_one()
+        get_database("analytics", "test_stats_2").Metric.insert(
+            {"_id": metric._id, "_type": "Metric", "value": 3})
+        with Metric.bind(database="test_stats_2"):
+            other = Metric.find_one(_id=metric._id)
+        ok_(other is not metric)
+        eq_((metric.value, other.value), (1, 3))
+        ok_(Metric.get_cache(metric._id) is metric)
+    finally:
+        disconnect("analytics")
+
+    ok_(get_connection("analytics") is None)
+    try:
+        Metric.find_one()
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("Unknown connection alias did not raise")
+
+
+def test_parallel_map():
+    '''Map documents in _id ranges across processes'''
+    from operator import add
+    from mongoom.parallel import id_ranges
+
+    import os
+    # Forked workers connect again with these settings
+    connect("test_db", "localhost", 27017, alias="shared")
+    drop_database("test_db")
+    Asset.save_many([Asset(size=i) for i in xrange(20)])
+
+    ranges = id_ranges(Asset.find(decode=False), 4)
+    eq_(len(ranges), 4)
+    eq_(ranges[0][0], None)
+    eq_(ranges[-1][1], None)
+
+    eq_(Asset.parallel_map(asset_size, processes=1), range(20))
+    results = Asset.parallel_map(asset_size_pid, processes=2)
+    eq_([size for size, pid in results], range(20))
+    ok_(os.getpid() not in set(pid for size, pid in results))
+    eq_(Asset.parallel_map(asset_size, {"size": {"$gte": 10}},
+                           processes=2, reduce=add, initial=0),
+        sum(range(10, 20)))
+    eq_(Asset.parallel_map(asset_size, {"size": -1}, processes=2), [])
+
+
+def test_sync_indexes():
+    '''Declare several indexes and create them once'''
+    import warnings
+    from mongoom.indexes import check_queries, index_name, sync_indexes
+    drop_database("test_db")
+
+    class Session(Document):
+        _indexes = [
+            {"key_or_list": [("user", 1), ("created", -1)]},
+            {"key_or_list": "token", "unique": True, "sparse": True},
+            {"key_or_list": "created", "expireAfterSeconds": 3600},
+        ]
+        user = Field(User)
+        token = Field(basestring)
+        created = Field(datetime, default=datetime.utcnow)
+
+    eq_(index_name(Session.indexes()[0]), "user_1_created_-1")
+    eq_(index_name(Session.indexes()[1]), "token_1")
+
+    get_database().Session.ensure_index("stale")
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter("always")
+        report = sync_indexes([Session])
+    eq_(report["Session"]["created"],
+        ["created_1", "token_1", "user_1_created_-1"])
+    eq_(report["Session"]["extra"], ["stale_1"])
+    eq_(len(caught), 1)
+    info = get_database().Session.index_information()
+    ok_(info["token_1"]["unique"])
+    eq_(info["created_1"]["expireAfterSeconds"], 3600)
+
+    eq_(Session.sync_indexes(drop=True), {"created": [], "extra": ["stale_1"]})
+    ok_("stale_1" not in get_database().Session.index_information())
+
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter("always")
+        scans = check_queries([Session.find(token="abc"),
+                               Session.find(ip="127.0.0.1")])
+    eq_([query.spec for query in scans], [{"ip": "127.0.0.1"}])
+    eq_(len(caught), 1)